@@ -0,0 +1,366 @@
+# benchmarks/run.py
+"""Benchmarks every pipeline stage on synthetic data against local stand-ins of the external services.
+
+    python -m benchmarks.run --output benchmarks/results.json
+    python -m benchmarks.run --baseline benchmarks/results.json --max_regression 0.1
+
+Each benchmark runs in a fresh process, so its peak RSS is its own. Results (throughput, p50/p99 latency of
+the benchmark's unit of work, peak RSS) are printed and optionally saved as JSON. With --baseline, the run
+is compared against a previous JSON and exits non-zero when a benchmark regressed beyond --max_regression.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import synthetic
+from benchmarks.stubs import FakeReddit, FakeTextAnalytics, StubServer
+
+BENCHMARKS = {}
+# cluster_recall: share of the matches at the similarity threshold a lookup must find, and largest share of
+# the index it may score exactly (unrelated issues must be ruled out by their sketches)
+MIN_RECALL = 0.99
+MAX_CANDIDATE_FRACTION = 0.01
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+def percentile(values, q):
+    # Nearest-rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Skip(Exception):
+    pass
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+@benchmark("dataset_build")
+def bench_dataset_build(args):
+    from dataset_pipeline import JiraIndex, build_dataset
+    reddit_data = synthetic.reddit_comments(args.comments, seed=args.seed)
+    jira_data = synthetic.jira_issues(args.issues, seed=args.seed)
+    index_seconds, index = _timed(JiraIndex, jira_data)
+    latencies, pairs = [], 0
+    for start in range(0, len(reddit_data), args.chunk_size):
+        seconds, chunk_pairs = _timed(build_dataset, reddit_data[start:start + args.chunk_size], jira_data, index)
+        latencies.append(seconds)
+        pairs += len(chunk_pairs)
+    return len(reddit_data), latencies, {"unit": f"{args.chunk_size} comments", "pairs": pairs,
+                                         "index_build_s": index_seconds}
+
+
+def _load_tokenizer(args):
+    try:
+        from datasets import Dataset
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise Skip(f"missing dependency: {e}")
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
+    except Exception as e:
+        raise Skip(f"could not load tokenizer {args.tokenizer}: {e}")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return Dataset.from_dict(synthetic.training_pairs(args.rows, seed=args.seed)), tokenizer
+
+
+@benchmark("tokenize_bert")
+def bench_tokenize_bert(args):
+    raw, tokenizer = _load_tokenizer(args)
+    from preprocess_pipeline import tokenize
+    from train_pipeline_bertVersion import preprocess_function
+    latencies = []
+    for _ in range(args.repeat):
+        seconds, _ = _timed(tokenize, raw, lambda x: preprocess_function(x, tokenizer, "summarization"),
+                            num_proc=args.num_proc)
+        latencies.append(seconds)
+    return len(raw) * args.repeat, latencies, {"unit": f"{len(raw)} rows", "tokenizer": args.tokenizer}
+
+
+@benchmark("tokenize_llama3")
+def bench_tokenize_llama3(args):
+    raw, tokenizer = _load_tokenizer(args)
+    try:
+        import train_pipeline_llama3
+    except ImportError as e:
+        raise Skip(f"train_pipeline_llama3 is not importable: {e}")
+    train_pipeline_llama3.tokenizer = tokenizer
+    latencies, tokens = [], 0
+    for _ in range(args.repeat):
+        seconds, dataset = _timed(train_pipeline_llama3.build_dataset, "summarization", raw, num_proc=args.num_proc)
+        latencies.append(seconds)
+        tokens = sum(dataset["length"])
+    return len(raw) * args.repeat, latencies, {"unit": f"{len(raw)} rows", "tokenizer": args.tokenizer,
+                                               "tokens_per_pass": tokens}
+
+
+@benchmark("generate_ticket")
+def bench_generate_ticket(args):
+    from inference_pipeline import VLLMBackend, generate_ticket
+    texts = [record["text"] for record in synthetic.reddit_comments(args.requests, seed=args.seed)]
+    with StubServer(latency=args.llm_latency, per_item_latency=args.llm_item_latency) as server:
+        backend = VLLMBackend(server_url=f"{server.url}/v1/completions")
+        latencies = [_timed(generate_ticket, text, backend=backend)[0] for text in texts]
+        backend.close()
+    return len(texts), latencies, {"unit": "request"}
+
+
+@benchmark("generate_tickets")
+def bench_generate_tickets(args):
+    from inference_pipeline import VLLMBackend, generate_tickets
+    texts = [record["text"] for record in synthetic.reddit_comments(args.requests, seed=args.seed)]
+    with StubServer(latency=args.llm_latency, per_item_latency=args.llm_item_latency) as server:
+        backend = VLLMBackend(server_url=f"{server.url}/v1/completions")
+        results = generate_tickets(texts, backend=backend)
+        backend.close()
+        requests_made = server.requests
+    return len(texts), [result.latency for result in results], {"unit": "micro-batch request",
+                                                                "http_requests": requests_made}
+
+
+def _make_analyzer(args, server, workdir, run):
+    from srcdata import reddit
+    from srcdata.clustering import ComplaintClusterer, ComplaintIndex
+    for name in ("RedditAnalyzer", "JiraClient", "StateStore", "CommentPreFilter", "ComplaintClusterer"):
+        logging.getLogger(name).setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    analyzer = reddit.RedditAnalyzer(
+        "client", "secret", "password", "benchmarks", "user", "https://localhost", "key",
+        "bench@example.com", "token", server.url, "BENCH", "reporter", "Bug",
+        state_path=os.path.join(workdir, f"state-{run}.db"),
+        clusterer=ComplaintClusterer(ComplaintIndex(os.path.join(workdir, f"index-{run}.db"))),
+    )
+    analyzer.reddit = FakeReddit({"bench": synthetic.reddit_thread(args.reddit_comments, seed=args.seed)},
+                                 latency=args.reddit_latency)
+    analyzer.text_analytics_client = FakeTextAnalytics(latency=args.azure_latency)
+    return analyzer
+
+
+def _bench_search(args, run_once):
+    latencies = []
+    with StubServer(latency=args.jira_latency) as server, tempfile.TemporaryDirectory() as workdir:
+        for run in range(args.repeat):
+            # Fresh state every run, so each one processes the whole thread
+            analyzer = _make_analyzer(args, server, workdir, run)
+            latencies.append(_timed(run_once, analyzer)[0])
+        jira_requests = server.requests
+    return args.reddit_comments * args.repeat, latencies, {"unit": f"{args.reddit_comments}-comment thread",
+                                                           "jira_requests": jira_requests}
+
+
+def _vector_at(rng, vector, similarity):
+    # Unit vector at exactly this cosine similarity to the unit vector `vector`
+    noise = [rng.gauss(0, 1) for _ in vector]
+    along = sum(x * y for x, y in zip(noise, vector))
+    orthogonal = [x - along * y for x, y in zip(noise, vector)]
+    norm = sum(x * x for x in orthogonal) ** 0.5
+    scale = (1 - similarity ** 2) ** 0.5 / norm
+    return [similarity * y + scale * x for x, y in zip(orthogonal, vector)]
+
+
+@benchmark("cluster_recall")
+def bench_cluster_recall(args):
+    # Index lookups of complaints exactly at SIMILARITY_THRESHOLD from an indexed issue. Fails when the lookups
+    # miss more of these matches than MIN_RECALL allows, or score more than MAX_CANDIDATE_FRACTION of the index
+    import random
+    from srcdata.clustering import ComplaintIndex, SIMILARITY_THRESHOLD
+    logging.getLogger("ComplaintClusterer").setLevel(logging.WARNING)
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        index = ComplaintIndex(os.path.join(workdir, "index.db"))
+        issues = []
+        for i in range(args.recall_issues):
+            vector = [rng.gauss(0, 1) for _ in range(index.dim)]
+            norm = sum(x * x for x in vector) ** 0.5
+            issues.append([x / norm for x in vector])
+        insert_seconds, _ = _timed(index.update, [(f"BENCH-{i}", f"issue {i}", vector) for i, vector in enumerate(issues)])
+        # A hair above the threshold, so float32 storage cannot push the exact similarity below it
+        similarity = SIMILARITY_THRESHOLD + 1e-4
+        latencies, found, candidates = [], 0, 0
+        for i, vector in enumerate(issues):
+            seconds, match = _timed(index.nearest, _vector_at(rng, vector, similarity))
+            latencies.append(seconds)
+            found += match is not None and match[0] == f"BENCH-{i}"
+            candidates += index.last_candidates
+        expected_recall = index.recall(similarity)
+        index.close()
+    recall = found / len(issues)
+    candidate_fraction = candidates / len(issues) / len(issues)
+    if recall < MIN_RECALL:
+        raise RuntimeError(f"Recall {recall:.3f} at similarity {SIMILARITY_THRESHOLD} is below {MIN_RECALL}")
+    if candidate_fraction > MAX_CANDIDATE_FRACTION:
+        raise RuntimeError(f"Lookups scored {candidate_fraction:.1%} of the index, more than {MAX_CANDIDATE_FRACTION:.1%}")
+    return len(issues), latencies, {"unit": "lookup", "recall": recall, "expected_recall": expected_recall,
+                                    "candidate_fraction": candidate_fraction, "insert_s": insert_seconds}
+
+
+@benchmark("search_reddits")
+def bench_search_reddits(args):
+    return _bench_search(args, lambda analyzer: analyzer.search_reddits("bench"))
+
+
+@benchmark("search_reddits_async")
+def bench_search_reddits_async(args):
+    return _bench_search(args, lambda analyzer: asyncio.run(analyzer.search_reddits_async("bench")))
+
+
+def _run_in_child(name, args, conn):
+    try:
+        start = time.perf_counter()
+        items, latencies, extra = BENCHMARKS[name](args)
+        wall = time.perf_counter() - start
+        conn.send({
+            "status": "ok",
+            "items": items,
+            "seconds": wall,
+            "throughput_per_s": items / wall if wall else None,
+            "operations": len(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+            "peak_rss_mb": peak_rss_mb(),
+            **extra,
+        })
+    except Skip as e:
+        conn.send({"status": "skipped", "reason": str(e)})
+    except Exception as e:
+        conn.send({"status": "error", "reason": f"{e}", "traceback": traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def run_benchmark(name, args):
+    # spawn, not fork: the child starts from a clean interpreter so peak RSS only covers this benchmark
+    context = multiprocessing.get_context("spawn")
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_run_in_child, args=(name, args, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {"status": "error", "reason": "benchmark process died"}
+    process.join()
+    return result
+
+
+def compare(results, baseline, max_regression):
+    # Regressions of throughput (lower) or p99 latency (higher) beyond max_regression, as messages
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("benchmarks", {}).get(name)
+        if not before or result.get("status") != "ok" or before.get("status") != "ok":
+            continue
+        if before["throughput_per_s"] and result["throughput_per_s"] < before["throughput_per_s"] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {before['throughput_per_s']:.1f}/s -> {result['throughput_per_s']:.1f}/s")
+        if before["p99_ms"] and result["p99_ms"] > before["p99_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: p99 {before['p99_ms']:.1f} ms -> {result['p99_ms']:.1f} ms")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'benchmark':<22}{'items/s':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}  unit")
+    for name, result in results.items():
+        if result["status"] != "ok":
+            print(f"{name:<22}{result['status']}: {result['reason']}")
+            continue
+        print(f"{name:<22}{result['throughput_per_s']:>12.1f}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['peak_rss_mb']:>10.1f}  {result['unit']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--output", type=str, default=None, help="Write results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON of a previous run to compare against")
+    parser.add_argument("--max_regression", type=float, default=0.1,
+                        help="Allowed relative drop in throughput / rise in p99 before a run fails")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Passes of the tokenization and Reddit benchmarks")
+    # dataset_build
+    parser.add_argument("--comments", type=int, default=50000)
+    parser.add_argument("--issues", type=int, default=1000)
+    parser.add_argument("--chunk_size", type=int, default=1000)
+    # tokenization
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--tokenizer", type=str, default="facebook/bart-base")
+    parser.add_argument("--num_proc", type=int, default=None)
+    # inference
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--llm_latency", type=float, default=0.02, help="Seconds per completions request")
+    parser.add_argument("--llm_item_latency", type=float, default=0.002, help="Extra seconds per prompt")
+    # cluster_recall
+    parser.add_argument("--recall_issues", type=int, default=5000, help="Indexed issues, each looked up once")
+    # Reddit -> Jira
+    parser.add_argument("--reddit_comments", type=int, default=500)
+    parser.add_argument("--reddit_latency", type=float, default=0.05, help="Seconds per Reddit API call")
+    parser.add_argument("--azure_latency", type=float, default=0.05, help="Seconds per Azure call")
+    parser.add_argument("--jira_latency", type=float, default=0.02, help="Seconds per Jira request")
+    parser.add_argument("--verbose", action="store_true", help="Keep the debug logs of the Reddit pipeline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"Running {name}...")
+        results[name] = run_benchmark(name, args)
+        if results[name]["status"] == "error":
+            print(results[name].get("traceback", results[name]["reason"]))
+    print_results(results)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        "benchmarks": results,
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+        print(f"No regression beyond {args.max_regression:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# benchmarks/stubs.py
+# Local stand-ins for the external services, each with configurable injected latency:
+# an HTTP server speaking the vLLM completions and Jira REST endpoints used by the repo,
+# and in-process fakes of the PRAW and Azure Text Analytics clients.
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from benchmarks.synthetic import COMPLAINTS
+
+_ISSUE_COMMENT = re.compile(r"/rest/api/2/issue/[^/]+/comment$")
+
+
+class StubServer:
+    """Serves /v1/completions (vLLM) and the Jira endpoints on 127.0.0.1 in a background thread.
+
+    `latency` is slept once per request, `per_item_latency` once per prompt or created issue.
+    """
+    def __init__(self, latency=0.0, per_item_latency=0.0):
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.requests = 0
+        self._keys = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _wait(self, items):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency + self.per_item_latency * items)
+
+    def _next_key(self):
+        with self._lock:
+            return f"BENCH-{next(self._keys)}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Keep-alive responses must not wait on delayed ACKs, or every request gains ~40 ms
+            disable_nagle_algorithm = True
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/rest/api/3/search"):
+                    # No existing issues: every comment is new to Jira
+                    stub._wait(1)
+                    return self._send(200, {"startAt": 0, "total": 0, "issues": []})
+                self._send(404, {})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                path = self.path.split("?")[0]
+                if path == "/v1/completions":
+                    prompts = payload["prompt"] if isinstance(payload["prompt"], list) else [payload["prompt"]]
+                    stub._wait(len(prompts))
+                    return self._send(200, {"choices": [
+                        {"index": i, "text": f"Summary: {prompt.splitlines()[0][:80]}\nPriority: Medium"}
+                        for i, prompt in enumerate(prompts)
+                    ]})
+                if path == "/rest/api/2/issue/bulk":
+                    updates = payload.get("issueUpdates", [])
+                    stub._wait(len(updates))
+                    keys = [stub._next_key() for _ in updates]
+                    return self._send(201, {"issues": [{"id": key, "key": key} for key in keys], "errors": []})
+                if path == "/rest/api/2/issue":
+                    stub._wait(1)
+                    return self._send(201, {"key": stub._next_key()})
+                if _ISSUE_COMMENT.match(path):
+                    stub._wait(1)
+                    return self._send(201, {"id": "1"})
+                self._send(404, {})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class _CommentForest:
+    def __init__(self, comments, per_more, latency):
+        self._comments = comments
+        self._per_more = per_more
+        self._latency = latency
+        self._loaded = min(len(comments), per_more)
+
+    def _remaining_mores(self):
+        return -(-(len(self._comments) - self._loaded) // self._per_more)
+
+    def replace_more(self, limit=32):
+        # Each MoreComments expansion is one Reddit API call
+        expansions = self._remaining_mores() if limit is None else min(limit, self._remaining_mores())
+        time.sleep(self._latency * expansions)
+        self._loaded = min(len(self._comments), self._loaded + expansions * self._per_more)
+        return [object()] * self._remaining_mores()
+
+    def list(self):
+        return self._comments[:self._loaded]
+
+
+class FakeReddit:
+    """praw.Reddit stand-in serving pre-generated submissions; `per_more` comments per MoreComments."""
+    # Comments per listing page, and the most a listing returns, as on Reddit
+    LISTING_PAGE = 100
+    LISTING_MAX = 1000
+
+    def __init__(self, submissions, per_more=100, latency=0.0):
+        self._submissions = submissions
+        self.per_more = per_more
+        self.latency = latency
+
+    def submission(self, submission_id):
+        time.sleep(self.latency)
+        return SimpleNamespace(
+            id=submission_id,
+            comment_sort="confidence",
+            comments=_CommentForest(self._submissions[submission_id], self.per_more, self.latency),
+            subreddit=SimpleNamespace(comments=self._subreddit_comments),
+        )
+
+    def _subreddit_comments(self, limit=100):
+        # Newest comments of all submissions (one subreddit), with their `link_id`
+        listing = sorted(
+            ((comment, submission_id) for submission_id, comments in self._submissions.items() for comment in comments),
+            key=lambda item: item[0].created_utc, reverse=True,
+        )[:self.LISTING_MAX if limit is None else min(limit, self.LISTING_MAX)]
+        for position, (comment, submission_id) in enumerate(listing):
+            if position % self.LISTING_PAGE == 0:
+                time.sleep(self.latency)
+            comment.link_id = f"t3_{submission_id}"
+            yield comment
+
+
+class FakeTextAnalytics:
+    """TextAnalyticsClient stand-in: English everywhere, negative when a comment contains a complaint."""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def _wait(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def detect_language(self, documents):
+        self._wait()
+        language = SimpleNamespace(name="English", iso6391_name="en", confidence_score=1.0)
+        return [SimpleNamespace(is_error=False, primary_language=language) for _ in documents]
+
+    def analyze_sentiment(self, documents, show_opinion_mining=False, language=None):
+        self._wait()
+        results = []
+        for document in documents:
+            complaint = next((phrase for phrase in COMPLAINTS if phrase in document), None)
+            opinions = []
+            if complaint:
+                target = SimpleNamespace(text=document.split()[0], sentiment="negative")
+                opinions.append(SimpleNamespace(target=target, assessments=[SimpleNamespace(text=complaint)]))
+            results.append(SimpleNamespace(
+                is_error=False,
+                sentiment="negative" if complaint else "positive",
+                sentences=[SimpleNamespace(mined_opinions=opinions)],
+            ))
+        return results
+
+    def begin_abstract_summary(self, documents, language=None):
+        self._wait()
+        summaries = [
+            SimpleNamespace(is_error=False, summaries=[SimpleNamespace(text=" ".join(document.split()[:8]))])
+            for document in documents
+        ]
+        # The operation runs server side; waiting on the poller costs another round of latency
+        return SimpleNamespace(result=lambda: (time.sleep(self.latency), summaries)[1])
@@ -0,0 +1,82 @@
+# benchmarks/synthetic.py
+# Seeded generators of synthetic Reddit comments, Jira issues and training pairs, scaled to any size.
+import random
+from types import SimpleNamespace
+
+COMPONENTS = [
+    "Multiplayer", "Inventory", "Matchmaking", "Login", "Audio", "Graphics", "Controller", "Shop",
+    "Leaderboard", "Chat", "Save system", "Achievements", "Tutorial", "Crafting", "Map", "Voice chat",
+]
+PRIORITIES = ["Low", "Medium", "High"]
+COMPLAINTS = ["crashes", "freezes", "lags", "is broken", "is too slow", "does not load", "keeps disconnecting"]
+PRAISES = ["is great", "works well", "looks amazing", "is fun", "feels smooth"]
+FILLER = (
+    "after the last update every time I try again on my pc and console since yesterday with friends "
+    "honestly please fix this soon the game was fine before but now it really needs some attention "
+    "I reinstalled twice and checked my drivers nothing seems to help at all today"
+).split()
+
+
+def _sentence(rng, component, negative):
+    verb = rng.choice(COMPLAINTS if negative else PRAISES)
+    filler = " ".join(rng.sample(FILLER, rng.randint(4, 18)))
+    return f"{component} {verb} {filler}"
+
+
+def reddit_comments(n, seed=0, mention_rate=0.8, negative_rate=0.4):
+    # {"text": ...} records as in data/raw_reddit_comments.json; mention_rate of them name a component
+    rng = random.Random(seed)
+    records = []
+    for _ in range(n):
+        component = rng.choice(COMPONENTS).lower() if rng.random() < mention_rate else "the game"
+        records.append({"text": _sentence(rng, component, rng.random() < negative_rate)})
+    return records
+
+
+def jira_issues(n, seed=0):
+    # Issues as in data/raw_jira_issues.json; components beyond COMPONENTS are numbered variants
+    rng = random.Random(seed)
+    issues = []
+    for i in range(n):
+        component = COMPONENTS[i % len(COMPONENTS)]
+        if i >= len(COMPONENTS):
+            component = f"{component} {i // len(COMPONENTS)}"
+        issues.append({
+            "summary": f"{component} {rng.choice(COMPLAINTS)}",
+            "component": component,
+            "priority": rng.choice(PRIORITIES),
+        })
+    return issues
+
+
+def training_pairs(n, seed=0):
+    # Rows carrying the fields read by both training pipelines
+    rng = random.Random(seed)
+    rows = {"reddit_comment": [], "jira_summary": [], "label": [], "input": [], "target": []}
+    for _ in range(n):
+        component = rng.choice(COMPONENTS)
+        negative = rng.random() < 0.5
+        text = _sentence(rng, component.lower(), negative)
+        summary = f"{component} {rng.choice(COMPLAINTS)}"
+        rows["reddit_comment"].append(text)
+        rows["jira_summary"].append(summary)
+        rows["label"].append("bug" if negative else "other")
+        rows["input"].append(f"Reddit feedback: {text}")
+        rows["target"].append(f"Mitigation: {summary}\nComponent: {component}\nPriority: {rng.choice(PRIORITIES)}")
+    return rows
+
+
+def reddit_thread(n, seed=0, negative_rate=0.4):
+    # PRAW-like comment objects (id, body, author, created_utc, edited) of one submission
+    rng = random.Random(seed)
+    comments = []
+    for i in range(n):
+        component = rng.choice(COMPONENTS).lower()
+        comments.append(SimpleNamespace(
+            id=f"c{i:07d}",
+            body=_sentence(rng, component, rng.random() < negative_rate),
+            author=SimpleNamespace(name=f"user{rng.randrange(n * 4)}"),
+            created_utc=1_700_000_000.0 + i,
+            edited=False,
+        ))
+    return comments
@@ -1,42 +1,362 @@
-# dataset_builder.py
-import json
-import os
-from pathlib import Path
-
-RAW_REDDIT_FILE = "data/raw_reddit_comments.json"
-RAW_JIRA_FILE = "data/raw_jira_issues.json"
-PROCESSED_FILE = "data/processed_pairs.jsonl"
-
-def normalize_text(text):
-    return text.strip().replace("\n", " ").lower()
-
-def load_data(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-def build_dataset(reddit_data, jira_data):
-    pairs = []
-    for reddit in reddit_data:
-        reddit_text = normalize_text(reddit["text"])
-        best_match = max(jira_data, key=lambda x: x["component"] in reddit_text)
-        pairs.append({
-            "input": f"Reddit feedback: {reddit_text}",
-            "output": f"Mitigation: {best_match['summary']}\nComponent: {best_match['component']}\nPriority: {best_match['priority']}"
-        })
-    return pairs
-
-def save_jsonl(data, output_path):
-    with open(output_path, 'w', encoding='utf-8') as f:
-        for item in data:
-            f.write(json.dumps(item) + "\n")
-
-def main():
-    os.makedirs("data", exist_ok=True)
-    reddit_data = load_data(RAW_REDDIT_FILE)
-    jira_data = load_data(RAW_JIRA_FILE)
-    dataset = build_dataset(reddit_data, jira_data)
-    save_jsonl(dataset, PROCESSED_FILE)
-    print(f"Processed {len(dataset)} examples saved to {PROCESSED_FILE}")
-
-if __name__ == "__main__":
-    main()
+# dataset_builder.py
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import deque
+from itertools import islice
+from pathlib import Path
+
+RAW_REDDIT_FILE = "data/raw_reddit_comments.json"
+RAW_JIRA_FILE = "data/raw_jira_issues.json"
+PROCESSED_FILE = "data/processed_pairs.jsonl"
+READ_CHUNK_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+FLUSH_EVERY = 10000
+SHARD_SIZE = 5000
+MANIFEST_VERSION = 3
+
+# Read-only matching index used by the worker processes (see iter_sharded_lines).
+_worker_index = None
+
+def normalize_text(text):
+    return text.strip().replace("\n", " ").lower()
+
+def load_data(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def iter_records(file_path, chunk_size=READ_CHUNK_SIZE):
+    # Lazily yields the records of either a top-level JSON array or a JSONL file,
+    # holding at most one chunk (plus one partially read record) in memory.
+    with open(file_path, 'r', encoding='utf-8') as f:
+        head = f.read(chunk_size)
+        while head and not head.strip():
+            more = f.read(chunk_size)
+            if not more:
+                break
+            head += more
+        stripped = head.lstrip()
+        if stripped.startswith("["):
+            yield from _iter_json_array(f, stripped[1:], chunk_size)
+            return
+        pending = ""
+        while head:
+            lines = (pending + head).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            head = f.read(chunk_size)
+        if pending.strip():
+            yield json.loads(pending)
+
+def _iter_json_array(f, buf, chunk_size):
+    decoder = json.JSONDecoder()
+    pos = 0
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        if pos < len(buf):
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A value is complete only once its delimiter is in the buffer: "2." + "5" decodes as 2
+                # at a chunk edge. Only a number can be a valid prefix of a longer value.
+                after = end
+                while after < len(buf) and buf[after] in " \t\r\n":
+                    after += 1
+                if (after < len(buf) and buf[after] in ",]") or (after == len(buf) and eof):
+                    yield record
+                    pos = end
+                    continue
+                if after < len(buf) and (eof or buf[end:].strip("0123456789.eE+-")):
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buf, after)
+        if eof:
+            raise ValueError("Unexpected end of JSON array")
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+class JiraIndex:
+    # Aho-Corasick automaton over the normalized Jira components. Built once per run,
+    # after which matching a comment is linear in the comment length (plus the number of hits).
+    def __init__(self, jira_data):
+        self.issues = list(jira_data)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for issue_idx, issue in enumerate(self.issues):
+            component = normalize_text(issue.get("component") or "")
+            if component:
+                self._add_pattern(component, issue_idx)
+        self._build_failure_links()
+
+    def _add_pattern(self, pattern, issue_idx):
+        node = 0
+        for char in pattern:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append(issue_idx)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                # Fold the suffix outputs in so matching never walks the failure chain for hits.
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def candidates(self, text):
+        # Indices (in jira_data order) of all issues whose component occurs in the normalized text.
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        found = set()
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return sorted(found)
+
+    def match(self, text):
+        # Same tie-break as the old max() scan: the first matching issue in jira_data order.
+        # Returns None when no component occurs in the text.
+        found = self.candidates(text)
+        return self.issues[found[0]] if found else None
+
+def make_pair(reddit_text, issue):
+    return {
+        "input": f"Reddit feedback: {reddit_text}",
+        "output": f"Mitigation: {issue['summary']}\nComponent: {issue['component']}\nPriority: {issue['priority']}"
+    }
+
+def iter_pairs(reddit_data, index, stats=None):
+    # Generator counterpart of build_dataset: pairs are produced one comment at a time,
+    # so reddit_data can be a lazy iterator (see iter_records).
+    for reddit in reddit_data:
+        reddit_text = normalize_text(reddit["text"])
+        best_match = index.match(reddit_text)
+        if stats is not None:
+            stats["comments"] = stats.get("comments", 0) + 1
+        if best_match is None:
+            continue
+        yield make_pair(reddit_text, best_match)
+
+def build_dataset(reddit_data, jira_data, index=None):
+    return list(iter_pairs(reddit_data, index or JiraIndex(jira_data)))
+
+def save_jsonl(data, output_path, flush_every=FLUSH_EVERY, mode='w'):
+    count = 0
+    with open(output_path, mode, encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        for item in data:
+            f.write(json.dumps(item) + "\n")
+            count += 1
+            if count % flush_every == 0:
+                f.flush()
+    return count
+
+def iter_shards(records, shard_size=SHARD_SIZE):
+    records = iter(records)
+    while True:
+        shard = list(islice(records, shard_size))
+        if not shard:
+            return
+        yield shard
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+def _process_shard(shard):
+    stats = {}
+    lines = "".join(json.dumps(pair) + "\n" for pair in iter_pairs(shard, _worker_index, stats))
+    return lines, stats.get("comments", 0)
+
+def iter_sharded_lines(records, index, workers, shard_size=SHARD_SIZE, stats=None):
+    # Yields the serialized JSONL text of each shard in input order, so the merged output is
+    # byte-identical to save_jsonl(iter_pairs(...)). With fork the index is inherited by the
+    # workers copy-on-write; otherwise it is pickled once per worker, never per shard.
+    global _worker_index
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+        _worker_index = index
+        initializer, initargs = None, ()
+    else:
+        ctx = multiprocessing.get_context()
+        initializer, initargs = _init_worker, (index,)
+    # Bound the shards in flight so the Reddit input is still streamed rather than queued up front.
+    max_pending = workers * 2
+    with ctx.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for shard in iter_shards(records, shard_size):
+            pending.append(pool.apply_async(_process_shard, (shard,)))
+            while len(pending) >= max_pending:
+                yield _collect_shard(pending.popleft(), stats)
+        while pending:
+            yield _collect_shard(pending.popleft(), stats)
+
+def _collect_shard(result, stats):
+    lines, comments = result.get()
+    if stats is not None:
+        stats["comments"] = stats.get("comments", 0) + comments
+    return lines
+
+def save_lines(chunks, output_path, mode='w'):
+    count = 0
+    with open(output_path, mode, encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        for chunk in chunks:
+            f.write(chunk)
+            f.flush()
+            count += chunk.count("\n")
+    return count
+
+def record_hash(record):
+    payload = json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def jira_fingerprint(jira_data):
+    # Only the fields that drive matching or end up in the pairs; edits to descriptions,
+    # assignees etc. do not invalidate an existing dataset.
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(MANIFEST_VERSION).encode("utf-8"))
+    for issue in jira_data:
+        fields = [issue.get("component"), issue.get("summary"), issue.get("priority")]
+        digest.update(json.dumps(fields, ensure_ascii=False).encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    manifest = load_data(manifest_path)
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def output_digest(output_path, start=0, end=None, digest=None):
+    # Hashes bytes [start, end) of the output into digest (a new one by default).
+    digest = digest or hashlib.blake2b(digest_size=16)
+    with open(output_path, 'rb') as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            chunk = f.read(READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest
+
+def save_manifest(manifest_path, fingerprint, comment_hashes, output_size, output_hash):
+    # output_size: byte length of the output covering these comments; anything past it is an interrupted append.
+    # output_hash: digest of those bytes, so an output rewritten since (e.g. by a full rebuild) is not truncated.
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            "version": MANIFEST_VERSION,
+            "jira_fingerprint": fingerprint,
+            "comments": sorted(comment_hashes),
+            "output_size": output_size,
+            "output_hash": output_hash,
+        }, f)
+    os.replace(tmp_path, manifest_path)
+
+def iter_new_records(records, known_hashes, seen_hashes):
+    # Skips comments already recorded in the manifest and collects the hashes of the rest.
+    for record in records:
+        digest = record_hash(record)
+        if digest in known_hashes:
+            continue
+        seen_hashes.add(digest)
+        yield record
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reddit_path", type=str, default=RAW_REDDIT_FILE)
+    parser.add_argument("--jira_path", type=str, default=RAW_JIRA_FILE)
+    parser.add_argument("--output_path", type=str, default=PROCESSED_FILE)
+    parser.add_argument("--flush_every", type=int, default=FLUSH_EVERY)
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to build the pairs")
+    parser.add_argument("--shard_size", type=int, default=SHARD_SIZE, help="Comments per shard in --workers mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Append pairs only for comments not recorded in the manifest")
+    parser.add_argument("--manifest_path", type=str, default=None,
+                        help="Defaults to <output_path>.manifest.json")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    os.makedirs(os.path.dirname(args.output_path) or ".", exist_ok=True)
+    # Only the Jira index is held in memory; Reddit comments are streamed through to the output.
+    jira_data = load_data(args.jira_path)
+    index = JiraIndex(jira_data)
+    stats = {}
+    records = iter_records(args.reddit_path)
+
+    mode = 'w'
+    manifest_path = args.manifest_path or args.output_path + ".manifest.json"
+    if args.incremental:
+        fingerprint = jira_fingerprint(jira_data)
+        manifest = load_manifest(manifest_path)
+        known_hashes = set()
+        digest = None
+        if (manifest and manifest["jira_fingerprint"] == fingerprint and os.path.exists(args.output_path)
+                and os.path.getsize(args.output_path) >= manifest["output_size"]):
+            # The output may have been rewritten since, e.g. by a full rebuild; only truncate the one the manifest describes
+            digest = output_digest(args.output_path, end=manifest["output_size"])
+            if digest.hexdigest() != manifest["output_hash"]:
+                digest = None
+        if digest:
+            known_hashes = set(manifest["comments"])
+            mode = 'a'
+            # Drop the pairs of an interrupted append; their comments are not in the manifest and are redone
+            with open(args.output_path, 'ab') as f:
+                f.truncate(manifest["output_size"])
+            print(f"Incremental build: {len(known_hashes)} comments already processed")
+        else:
+            print("No usable manifest, the Jira snapshot or the output changed, rebuilding from scratch")
+        new_hashes = set()
+        records = iter_new_records(records, known_hashes, new_hashes)
+    elif os.path.exists(manifest_path):
+        # A full rebuild rewrites the output, so a manifest from an earlier incremental run no longer describes it.
+        os.remove(manifest_path)
+
+    if args.workers > 1:
+        chunks = iter_sharded_lines(records, index, args.workers, args.shard_size, stats)
+        count = save_lines(chunks, args.output_path, mode=mode)
+    else:
+        pairs = iter_pairs(records, index, stats)
+        count = save_jsonl(pairs, args.output_path, flush_every=args.flush_every, mode=mode)
+
+    if args.incremental:
+        # Written only once the output is complete; an interrupted run is truncated back and redone.
+        start = manifest["output_size"] if digest else 0
+        digest = output_digest(args.output_path, start=start, digest=digest)
+        save_manifest(manifest_path, fingerprint, known_hashes | new_hashes, os.path.getsize(args.output_path),
+                      digest.hexdigest())
+    print(f"Processed {count} examples saved to {args.output_path}")
+    print(f"Skipped {stats.get('comments', 0) - count} comments without a matching Jira component")
+
+if __name__ == "__main__":
+    main()
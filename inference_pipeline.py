@@ -1,23 +1,535 @@
-# Inference of the model with vLLM. Please setup your own server: https://github.com/vllm-project/vllm
-# An example is provided in the main function below.
-import requests
-
-VLLM_SERVER = "http://localhost:8000/v1/completions"  # Adjust to your vLLM endpoint
-PROMPT_TEMPLATE = """Reddit feedback: {text}
-###
-"""
-
-def generate_ticket(text):
-    payload = {
-        "model": "llama-3-8b-instruct",  # Must match what your vLLM server exposes
-        "prompt": PROMPT_TEMPLATE.format(text=text),
-        "temperature": 0.4,
-        "max_tokens": 512,
-    }
-    response = requests.post(VLLM_SERVER, json=payload)
-    return response.json()["choices"][0]["text"]
-
-if __name__ == "__main__":
-    test_input = "The game lags when switching weapons and crashes in multiplayer mode."
-    output = generate_ticket(test_input)
-    print("Predicted output:\n", output)
+# Inference of the model with vLLM. Please setup your own server: https://github.com/vllm-project/vllm
+# Alternatively, LocalBackend loads a fine-tuned checkpoint in-process (no server needed).
+# An example is provided in the main function below.
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from dataset_pipeline import iter_records
+
+VLLM_SERVER = "http://localhost:8000/v1/completions"  # Adjust to your vLLM endpoint
+MODEL_NAME = "llama-3-8b-instruct"  # Must match what your vLLM server exposes
+TEMPERATURE = 0.4
+MAX_TOKENS = 512
+REQUEST_TIMEOUT = 120  # seconds, per HTTP request (i.e. per micro-batch)
+BATCH_SIZE = 16  # prompts per /v1/completions request
+MAX_CONCURRENCY = 8  # requests in flight against the server
+MAX_RETRIES = 3
+CHECKPOINT_EVERY = 10  # completed micro-batches between checkpoints in the batch job
+CACHE_MAX_ENTRIES = 1_000_000
+LOCAL_MAX_BATCH_SIZE = 16  # prompts per generate() call in LocalBackend
+LOCAL_MAX_WAIT = 0.01  # seconds LocalBackend waits for more requests to join a batch
+PROMPT_TEMPLATE = """Reddit feedback: {text}
+###
+"""
+
+# output: generated ticket text, latency: seconds spent on the HTTP request that produced it
+TicketResult = namedtuple("TicketResult", ["output", "latency"])
+
+_default_session = None
+_session_lock = threading.Lock()
+
+def create_session(pool_size=MAX_CONCURRENCY, max_retries=MAX_RETRIES):
+    # Keep-alive connection pool sized for the number of requests in flight. Completions are
+    # idempotent for our purposes, so POSTs are retried on connection errors and 429/5xx.
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session():
+    global _default_session
+    with _session_lock:
+        if _default_session is None:
+            _default_session = create_session()
+        return _default_session
+
+def build_payload(prompts, model=MODEL_NAME):
+    return {
+        "model": model,
+        "prompt": prompts,
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+    }
+
+def complete_batch(texts, session=None, server_url=VLLM_SERVER, timeout=REQUEST_TIMEOUT, model=MODEL_NAME):
+    # One /v1/completions request for a micro-batch; vLLM schedules the prompts together.
+    session = session or get_session()
+    payload = build_payload([PROMPT_TEMPLATE.format(text=text) for text in texts], model)
+    start = time.perf_counter()
+    response = session.post(server_url, json=payload, timeout=timeout)
+    response.raise_for_status()
+    latency = time.perf_counter() - start
+    outputs = [None] * len(texts)
+    for choice in response.json()["choices"]:
+        outputs[choice["index"]] = choice["text"]
+    return [TicketResult(output, latency) for output in outputs]
+
+class InferenceBackend:
+    # Turns a list of feedback texts into one TicketResult per text, in order. Backends must be
+    # safe to call from several threads at once (generate_tickets runs micro-batches concurrently).
+    model_name = MODEL_NAME
+
+    def complete(self, texts):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class VLLMBackend(InferenceBackend):
+    def __init__(self, server_url=VLLM_SERVER, model=MODEL_NAME, timeout=REQUEST_TIMEOUT, session=None):
+        self.server_url = server_url
+        self.model_name = model
+        self.timeout = timeout
+        self.session = session or get_session()
+
+    def complete(self, texts):
+        return complete_batch(texts, self.session, self.server_url, self.timeout, self.model_name)
+
+class LocalBackend(InferenceBackend):
+    # Runs a checkpoint written by train_pipeline_bertVersion.py (seq2seq) or train_pipeline_llama3.py
+    # (causal LM) in this process. The model is loaded once; concurrent complete() calls are queued
+    # and merged by a single worker thread into batches of up to max_batch_size prompts.
+    def __init__(self, model_dir, max_batch_size=LOCAL_MAX_BATCH_SIZE, max_wait=LOCAL_MAX_WAIT, device=None):
+        import torch
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoTokenizer
+
+        self._torch = torch
+        self.model_name = model_dir
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.is_encoder_decoder = AutoConfig.from_pretrained(model_dir).is_encoder_decoder
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        if self.is_encoder_decoder:
+            self.model = AutoModelForSeq2SeqLM.from_pretrained(model_dir)
+        else:
+            # Decoder-only models continue the prompt, so pad on the left to keep prompts flush with the output.
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            dtype = torch.float16 if self.device == "cuda" else torch.float32
+            self.model = AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=dtype)
+        self.model.to(self.device)
+        self.model.eval()
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._serve, name="LocalBackend", daemon=True)
+        self._worker.start()
+
+    def complete(self, texts):
+        future = Future()
+        self._requests.put((list(texts), future))
+        return future.result()
+
+    def close(self):
+        self._requests.put(None)
+        self._worker.join()
+
+    def _next_batch(self):
+        # Block for the first request, then gather whatever arrives within max_wait.
+        first = self._requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                start = time.perf_counter()
+                outputs = []
+                for offset in range(0, len(texts), self.max_batch_size):
+                    outputs.extend(self._generate(texts[offset:offset + self.max_batch_size]))
+                latency = time.perf_counter() - start
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            position = 0
+            for request_texts, future in batch:
+                chunk = outputs[position:position + len(request_texts)]
+                future.set_result([TicketResult(output, latency) for output in chunk])
+                position += len(request_texts)
+
+    def _generate(self, texts):
+        prompts = [PROMPT_TEMPLATE.format(text=text) for text in texts]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True).to(self.device)
+        with self._torch.inference_mode():
+            generated = self.model.generate(
+                **inputs,
+                max_new_tokens=MAX_TOKENS,
+                do_sample=TEMPERATURE > 0,
+                temperature=TEMPERATURE if TEMPERATURE > 0 else None,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        if not self.is_encoder_decoder:
+            generated = generated[:, inputs["input_ids"].shape[1]:]
+        return self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+
+_default_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    global _default_backend
+    with _backend_lock:
+        if _default_backend is None:
+            _default_backend = VLLMBackend()
+        return _default_backend
+
+class PromptCache:
+    # Persistent prompt -> completion cache in SQLite, keyed on the normalized text together with
+    # every generation setting that changes the output. Bounded to max_entries with LRU eviction.
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES, cache_sampled=True):
+        self.path = path
+        self.max_entries = max_entries
+        # With cache_sampled=False, runs with a nonzero temperature bypass the cache entirely.
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, output TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def make_key(text, model=MODEL_NAME, temperature=TEMPERATURE, max_tokens=MAX_TOKENS, template=PROMPT_TEMPLATE):
+        normalized = " ".join(text.lower().split())
+        payload = json.dumps([normalized, model, template, temperature, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def enabled_for(self, temperature=TEMPERATURE):
+        return self.cache_sampled or temperature == 0
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT output FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, output):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO completions (key, output, last_access) VALUES (?, ?, ?)", (key, output, time.time())
+            )
+            if cursor.rowcount:
+                self._size += 1
+            else:
+                self._conn.execute(
+                    "UPDATE completions SET output = ?, last_access = ? WHERE key = ?", (output, time.time(), key)
+                )
+            if self._size > self.max_entries:
+                # Evict down to 90% so the DELETE is amortized over many inserts.
+                excess = self._size - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM completions WHERE key IN "
+                    "(SELECT key FROM completions ORDER BY last_access LIMIT ?)", (excess,)
+                )
+                self._size -= excess
+            self._conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": self._size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def cached_complete_batch(texts, cache=None, backend=None):
+    # backend.complete that answers cache hits locally and sends each distinct miss only once.
+    backend = backend or get_backend()
+    if cache is None or not cache.enabled_for(TEMPERATURE):
+        return backend.complete(texts)
+    keys = [PromptCache.make_key(text, backend.model_name) for text in texts]
+    results = [None] * len(texts)
+    misses = {}
+    for position, key in enumerate(keys):
+        if key in misses:
+            misses[key].append(position)
+            continue
+        output = cache.get(key)
+        if output is None:
+            misses[key] = [position]
+        else:
+            results[position] = TicketResult(output, 0.0)
+    if misses:
+        miss_keys = list(misses)
+        completed = backend.complete([texts[misses[key][0]] for key in miss_keys])
+        for key, result in zip(miss_keys, completed):
+            cache.put(key, result.output)
+            for position in misses[key]:
+                results[position] = result
+    return results
+
+def _micro_batches(texts, batch_size):
+    return [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+
+def generate_ticket(text, backend=None, cache=None):
+    return cached_complete_batch([text], cache, backend)[0].output
+
+def generate_tickets(texts, batch_size=BATCH_SIZE, max_concurrency=MAX_CONCURRENCY, backend=None, cache=None):
+    # Returns one TicketResult per text, in input order. Defaults to the vLLM server at VLLM_SERVER.
+    texts = list(texts)
+    backend = backend or get_backend()
+    batches = _micro_batches(texts, batch_size)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        batch_results = executor.map(lambda batch: cached_complete_batch(batch, cache, backend), batches)
+        return [result for batch in batch_results for result in batch]
+
+async def agenerate_tickets(texts, batch_size=BATCH_SIZE, max_concurrency=MAX_CONCURRENCY, backend=None, cache=None):
+    # asyncio variant of generate_tickets; the blocking backend calls run in worker threads.
+    texts = list(texts)
+    backend = backend or get_backend()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(batch):
+        async with semaphore:
+            return await asyncio.to_thread(cached_complete_batch, batch, cache, backend)
+
+    batch_results = await asyncio.gather(*(run(batch) for batch in _micro_batches(texts, batch_size)))
+    return [result for batch in batch_results for result in batch]
+
+def input_identity(input_file):
+    # Path, size and content hash of a batch job input; a checkpoint only applies to the input it was taken on.
+    digest = hashlib.blake2b(digest_size=16)
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return {"path": os.path.abspath(input_file), "size": os.path.getsize(input_file), "hash": digest.hexdigest()}
+
+class Checkpoint:
+    # Progress of a batch job: every input index below `watermark` plus those in `done` has its
+    # prediction in the first `offset` bytes of the output file. Predictions are written in
+    # completion order, so `done` only holds the (bounded) out-of-order tail.
+    def __init__(self, path, input_id=None):
+        self.path = path
+        self.input_id = input_id
+        self.offset = 0
+        self.watermark = 0
+        self.done = set()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            saved_input = state.get("input")
+            if (self.input_id and saved_input
+                    and (saved_input["size"], saved_input["hash"]) != (self.input_id["size"], self.input_id["hash"])):
+                raise ValueError(f"Checkpoint {self.path} was taken on a different input ({saved_input['path']}); "
+                                 f"remove it or pass another --checkpoint_file to start over")
+            self.offset = state["offset"]
+            self.watermark = state["watermark"]
+            self.done = set(state["done"])
+
+    def is_done(self, index):
+        return index < self.watermark or index in self.done
+
+    def mark_done(self, index):
+        self.done.add(index)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def save(self, offset):
+        self.offset = offset
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"offset": self.offset, "watermark": self.watermark, "done": sorted(self.done),
+                       "input": self.input_id}, f)
+        os.replace(tmp_path, self.path)
+
+def _iter_pending_batches(input_file, text_field, checkpoint, batch_size):
+    batch = []
+    for index, record in enumerate(iter_records(input_file)):
+        if checkpoint.is_done(index):
+            continue
+        text = record if isinstance(record, str) else record[text_field]
+        batch.append((index, record, text))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _is_transient_error(exc):
+    # Connection problems and 429/5xx (already retried by the session) are worth another run of the job;
+    # anything else, e.g. a 400 for a prompt over the context length, fails again for the same records.
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+def _error_message(exc):
+    message = f"{type(exc).__name__}: {exc}"
+    response = getattr(exc, "response", None)
+    if response is not None and response.text:
+        message += f" ({response.text[:500]})"
+    return message
+
+def run_batch_job(input_file, output_file, checkpoint_file=None, text_field="text", batch_size=BATCH_SIZE,
+                  max_concurrency=MAX_CONCURRENCY, backend=None, checkpoint_every=CHECKPOINT_EVERY, cache=None):
+    # Streams input_file through the backend and appends one JSON line per prediction to output_file
+    # as soon as its micro-batch completes. Re-running with the same files resumes the job.
+    # A micro-batch the backend rejects is split until the failing records are isolated; those get an
+    # error line (`error` instead of `output`) so they are not retried on every resume.
+    checkpoint = Checkpoint(checkpoint_file or output_file + ".ckpt", input_identity(input_file))
+    checkpoint.load()
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    # Drop anything written after the last checkpoint; those inputs are not marked done and are redone.
+    with open(output_file, 'ab') as f:
+        f.truncate(checkpoint.offset)
+    if checkpoint.watermark or checkpoint.done:
+        print(f"Resuming from checkpoint: {checkpoint.watermark + len(checkpoint.done)} inputs already done")
+
+    backend = backend or get_backend()
+    completed = 0
+    failed = 0
+    with open(output_file, 'ab') as out, ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        in_flight = {}
+
+        def submit(batch):
+            texts = [text for _, _, text in batch]
+            in_flight[executor.submit(cached_complete_batch, texts, cache, backend)] = batch
+
+        def write_line(index, record, line):
+            if isinstance(record, dict) and "id" in record:
+                line["id"] = record["id"]
+            out.write((json.dumps(line) + "\n").encode("utf-8"))
+            checkpoint.mark_done(index)
+
+        def drain():
+            nonlocal completed, failed
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batch = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    if _is_transient_error(e):
+                        raise
+                    if len(batch) > 1:
+                        middle = len(batch) // 2
+                        submit(batch[:middle])
+                        submit(batch[middle:])
+                        continue
+                    index, record, text = batch[0]
+                    print(f"Input {index} failed: {_error_message(e)}")
+                    write_line(index, record, {"index": index, "input": text, "output": None,
+                                               "error": _error_message(e)})
+                    failed += 1
+                    results = []
+                for (index, record, text), result in zip(batch, results):
+                    write_line(index, record, {"index": index, "input": text, "output": result.output,
+                                               "latency": result.latency})
+                completed += 1
+                if completed % checkpoint_every == 0:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    checkpoint.save(out.tell())
+
+        for batch in _iter_pending_batches(input_file, text_field, checkpoint, batch_size):
+            submit(batch)
+            while len(in_flight) >= max_concurrency:
+                drain()
+        while in_flight:
+            drain()
+        out.flush()
+        os.fsync(out.fileno())
+        checkpoint.save(out.tell())
+    print(f"Wrote predictions for {checkpoint.watermark + len(checkpoint.done)} inputs to {output_file}"
+          f" ({failed} failed in this run)")
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=["vllm", "local"], default="vllm")
+    parser.add_argument("--model_dir", type=str, default=MODEL_NAME,
+                        help="Model name exposed by the vLLM server, or the checkpoint directory with --backend local")
+    parser.add_argument("--input_file", type=str, default=None, help="JSON array or JSONL of feedback records")
+    parser.add_argument("--output_file", type=str, default=None, help="JSONL file the predictions are appended to")
+    parser.add_argument("--checkpoint_file", type=str, default=None, help="Defaults to <output_file>.ckpt")
+    parser.add_argument("--text_field", type=str, default="text")
+    parser.add_argument("--server_url", type=str, default=VLLM_SERVER)
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max_concurrency", type=int, default=MAX_CONCURRENCY)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT)
+    parser.add_argument("--local_max_batch_size", type=int, default=LOCAL_MAX_BATCH_SIZE)
+    parser.add_argument("--checkpoint_every", type=int, default=CHECKPOINT_EVERY)
+    parser.add_argument("--cache_path", type=str, default=None,
+                        help="SQLite file used to cache completions across runs (disabled if not set)")
+    parser.add_argument("--cache_max_entries", type=int, default=CACHE_MAX_ENTRIES)
+    parser.add_argument("--no_cache_sampled", action="store_true",
+                        help="Bypass the cache when sampling with a nonzero temperature")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.backend == "local":
+        backend = LocalBackend(args.model_dir, max_batch_size=args.local_max_batch_size)
+    else:
+        backend = VLLMBackend(args.server_url, args.model_dir, args.timeout)
+    cache = None
+    if args.cache_path:
+        cache = PromptCache(args.cache_path, args.cache_max_entries, cache_sampled=not args.no_cache_sampled)
+    if args.input_file is None:
+        test_input = "The game lags when switching weapons and crashes in multiplayer mode."
+        output = generate_ticket(test_input, backend, cache)
+        print("Predicted output:\n", output)
+    elif args.output_file is None:
+        raise SystemExit("--output_file is required together with --input_file")
+    else:
+        run_batch_job(args.input_file, args.output_file, args.checkpoint_file, args.text_field, args.batch_size,
+                      args.max_concurrency, backend, args.checkpoint_every, cache)
+    backend.close()
+    if cache is not None:
+        print(f"Prompt cache: {cache.stats()}")
+        cache.close()
+
+if __name__ == "__main__":
+    main()
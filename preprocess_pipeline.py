@@ -0,0 +1,101 @@
+# preprocess_pipeline.py
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+from datasets import load_dataset, load_from_disk
+
+# Bump when the artifact layout changes, so every cached artifact is rebuilt
+ARTIFACT_VERSION = 1
+TOKENIZED_CACHE_DIR = "data/tokenized"
+MAP_BATCH_SIZE = 1000
+# Below this many rows per process, extra worker processes cost more than they save
+MIN_ROWS_PER_PROC = 1000
+HASH_CHUNK_SIZE = 1 << 20
+
+def file_hash(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def tokenizer_fingerprint(tokenizer):
+    # Identifies the tokenizer by its checkpoint and the settings that change its output, without
+    # serializing the whole vocabulary (which alone takes seconds for Llama 3)
+    return {
+        "name_or_path": tokenizer.name_or_path,
+        "class": type(tokenizer).__name__,
+        "vocab_size": len(tokenizer),
+        "special_tokens": tokenizer.special_tokens_map,
+        "padding_side": tokenizer.padding_side,
+        "truncation_side": tokenizer.truncation_side,
+    }
+
+def function_fingerprint(fn):
+    # Source of the preprocessing code, so editing it invalidates the artifacts it produced
+    try:
+        return inspect.getsource(fn)
+    except (OSError, TypeError):
+        return f"{fn.__module__}.{fn.__qualname__}"
+
+def artifact_path(dataset_path, tokenizer, task, max_input_length, max_target_length, preprocess=None,
+                  cache_dir=TOKENIZED_CACHE_DIR, **extra):
+    """Directory of the tokenized artifact for this source file, tokenizer, task and max lengths."""
+    key = {
+        "version": ARTIFACT_VERSION,
+        "source": file_hash(dataset_path),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "task": task,
+        "max_input_length": max_input_length,
+        "max_target_length": max_target_length,
+        "preprocess": function_fingerprint(preprocess) if preprocess is not None else None,
+        "extra": extra,
+    }
+    digest = hashlib.blake2b(json.dumps(key, sort_keys=True, default=str).encode('utf-8'), digest_size=16).hexdigest()
+    name = os.path.splitext(os.path.basename(dataset_path))[0]
+    return os.path.join(cache_dir, f"{name}-{task}-{digest}")
+
+def default_num_proc(num_rows):
+    return max(1, min(os.cpu_count() or 1, num_rows // MIN_ROWS_PER_PROC))
+
+def load_raw(dataset_path):
+    return load_dataset("json", data_files=dataset_path, split="train")
+
+def tokenize(raw_dataset, preprocess, num_proc=None, batch_size=MAP_BATCH_SIZE):
+    """Batched, multi-process map of `preprocess` over `raw_dataset`, dropping the raw text columns."""
+    if num_proc is None:
+        num_proc = default_num_proc(len(raw_dataset))
+    return raw_dataset.map(
+        preprocess,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc if num_proc > 1 else None,
+        remove_columns=raw_dataset.column_names,
+        desc="Tokenizing",
+    )
+
+def load_or_build(path, build, rebuild=False):
+    """Memory-maps the artifact at `path`, first building it with `build()` when missing (or when `rebuild`).
+
+    The artifact is written to a temporary directory and renamed into place, so an interrupted run never
+    leaves a partial artifact behind that a later run would load.
+    """
+    if rebuild and os.path.isdir(path):
+        shutil.rmtree(path)
+    if not os.path.isdir(path):
+        dataset = build()
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        dataset.save_to_disk(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another run built the same artifact concurrently; theirs is identical
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print(f"Saved tokenized dataset to {path}")
+    else:
+        print(f"Loading tokenized dataset from {path}")
+    return load_from_disk(path)
@@ -0,0 +1,361 @@
+import hashlib, logging, math, os, re, sqlite3, sys, threading, time
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(formatter)
+logger = logging.getLogger('ComplaintClusterer')
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+DEFAULT_INDEX_PATH = "complaint_index.db"
+EMBEDDING_DIM = 256
+# Lookups first compare SKETCH_BITS-bit sign sketches (random hyperplanes) by Hamming distance, then score
+# only the candidates exactly. The distance cut-off sits SKETCH_SIGMAS standard deviations above the expected
+# distance of a pair at the threshold: matches are all but certain to be candidates, unrelated issues are not.
+SKETCH_BITS = 256
+SKETCH_SIGMAS = 4.0
+SKETCH_SEED = 20250101
+# Rows added to the memory-mapped vector matrix whenever it is full
+MATRIX_GROWTH = 4096
+# Issues written per SQLite transaction by sync_issues
+SYNC_BATCH_SIZE = 500
+# Cosine similarity from which two complaints (or a complaint and an issue) are the same problem
+SIMILARITY_THRESHOLD = 0.7
+
+_WORD = re.compile(r"\w+")
+
+# A negative opinion extracted from one comment, before it becomes (part of) a ticket
+Complaint = namedtuple('Complaint', ['comment_id', 'summary', 'description', 'priority', 'text'])
+
+
+class HashingEmbedder:
+    # Dependency-free embedding: signed feature hashing of word unigrams and bigrams, L2 normalized.
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def _embed(self, text: str) -> List[float]:
+        words = _WORD.findall(text.lower())
+        vector = [0.0] * self.dim
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+            vector[value % self.dim] += 1.0 if value >> 63 else -1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+
+class SentenceTransformerEmbedder:
+    # Better semantic matches when sentence-transformers is installed, e.g. "all-MiniLM-L6-v2".
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        return [list(map(float, vector)) for vector in self.model.encode(list(texts), normalize_embeddings=True)]
+
+
+def _dot(a: Sequence[float], b: Sequence[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint16)
+
+
+def _separation(similarity: float) -> float:
+    # Probability that a random hyperplane separates two vectors at this cosine similarity: angle / pi
+    return math.acos(max(-1.0, min(1.0, similarity))) / math.pi
+
+
+def sketch_radius(similarity: float, bits=SKETCH_BITS, sigmas=SKETCH_SIGMAS) -> int:
+    # Hamming distance cut-off for the sketches of pairs at this similarity, whose distance is Binomial(bits, p)
+    p = _separation(similarity)
+    return min(bits, math.ceil(bits * p + sigmas * math.sqrt(bits * p * (1 - p))))
+
+
+def sketch_recall(similarity: float, radius: int, bits=SKETCH_BITS) -> float:
+    # Probability that a pair at this similarity is a candidate, i.e. that its sketches are within radius
+    p = _separation(similarity)
+    return sum(math.comb(bits, k) * p ** k * (1 - p) ** (bits - k) for k in range(min(radius, bits) + 1))
+
+
+# Persistent vector index of issue summaries, with incremental inserts. SQLite holds the issues and their
+# vectors; the vectors are mirrored into a float32 matrix memory-mapped from <path>.vectors (rebuilt from
+# SQLite when missing) and sketched in memory, so a lookup is two vectorized passes instead of a Python loop.
+class ComplaintIndex:
+    def __init__(self, path: str = DEFAULT_INDEX_PATH, dim=EMBEDDING_DIM, sketch_bits=SKETCH_BITS, seed=SKETCH_SEED):
+        self.path = path
+        self.matrix_path = f"{path}.vectors"
+        self.dim = dim
+        # Candidates scored exactly by the last lookup
+        self.last_candidates = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors (id INTEGER PRIMARY KEY, issue_key TEXT NOT NULL UNIQUE, "
+            "summary TEXT NOT NULL, vector BLOB NOT NULL, matrix_row INTEGER)"
+        )
+        if "matrix_row" not in {column[1] for column in self._conn.execute("PRAGMA table_info(vectors)")}:
+            # Index written before the matrix existed; its rows are assigned by _load
+            self._conn.execute("ALTER TABLE vectors ADD COLUMN matrix_row INTEGER")
+        # LSH buckets of earlier versions, superseded by the sketches
+        self._conn.execute("DROP TABLE IF EXISTS buckets")
+        self._conn.commit()
+        stored = self.get_meta("config")
+        if stored is not None and stored.split(":")[0] != str(dim):
+            raise ValueError(f"Complaint index {path} was built with {stored.split(':')[0]}-dimensional vectors, not {dim}")
+        self.set_meta("config", str(dim))
+        self._planes = np.random.default_rng(seed).standard_normal((sketch_bits, dim)).astype(np.float32)
+        self._matrix = None
+        self._load()
+
+    def get_meta(self, name: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+            self._conn.commit()
+
+    def _sketch(self, vectors) -> np.ndarray:
+        return np.packbits(np.asarray(vectors, dtype=np.float32) @ self._planes.T >= 0, axis=1)
+
+    def _resize(self, capacity: int):
+        # (Re)opens the matrix file with room for `capacity` rows; the file grows with zeros
+        if self._matrix is not None:
+            self._matrix.flush()
+            self._matrix = None
+        size = capacity * self.dim * 4
+        with open(self.matrix_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        old = len(self._keys)
+        self._keys.extend([None] * (capacity - old))
+        self._live = np.concatenate([self._live, np.zeros(capacity - old, dtype=bool)])
+        self._codes = np.concatenate([self._codes, np.zeros((capacity - old, self._codes.shape[1]), dtype=np.uint8)])
+
+    def _load(self):
+        self._keys: List[Optional[str]] = []
+        self._live = np.zeros(0, dtype=bool)
+        self._codes = np.zeros((0, self._planes.shape[0] // 8), dtype=np.uint8)
+        rows = self._conn.execute("SELECT id, matrix_row, issue_key FROM vectors").fetchall()
+        stored_rows = os.path.getsize(self.matrix_path) // (self.dim * 4) if os.path.exists(self.matrix_path) else 0
+        placed, missing = {}, []
+        for vector_id, matrix_row, issue_key in rows:
+            if matrix_row is not None and matrix_row < stored_rows and matrix_row not in placed:
+                placed[matrix_row] = issue_key
+            else:
+                missing.append(vector_id)
+        self._high = max(placed, default=-1) + 1
+        self._resize(max(MATRIX_GROWTH, stored_rows, self._high + len(missing)))
+        for matrix_row, issue_key in placed.items():
+            self._keys[matrix_row] = issue_key
+            self._live[matrix_row] = True
+        if missing:
+            # No usable matrix row (first open, lost or short matrix file): copy the vector from SQLite
+            for vector_id in missing:
+                issue_key, blob = self._conn.execute(
+                    "SELECT issue_key, vector FROM vectors WHERE id = ?", (vector_id,)
+                ).fetchone()
+                matrix_row = self._high
+                self._high += 1
+                self._matrix[matrix_row] = np.frombuffer(blob, dtype=np.float32)
+                self._conn.execute("UPDATE vectors SET matrix_row = ? WHERE id = ?", (matrix_row, vector_id))
+                self._keys[matrix_row] = issue_key
+                self._live[matrix_row] = True
+            self._matrix.flush()
+            self._conn.commit()
+            logger.info(f'Copied {len(missing)} vectors of complaint index {self.path} into {self.matrix_path}')
+        self._free = [matrix_row for matrix_row in range(self._high) if not self._live[matrix_row]]
+        for start in range(0, self._high, MATRIX_GROWTH):
+            stop = min(self._high, start + MATRIX_GROWTH)
+            self._codes[start:stop] = self._sketch(self._matrix[start:stop])
+
+    def _allocate(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._high == len(self._keys):
+            self._resize(len(self._keys) + max(MATRIX_GROWTH, len(self._keys) // 2))
+        self._high += 1
+        return self._high - 1
+
+    def _delete(self, issue_key: str) -> List[int]:
+        row = self._conn.execute("SELECT id, matrix_row FROM vectors WHERE issue_key = ?", (issue_key,)).fetchone()
+        if not row:
+            return []
+        self._conn.execute("DELETE FROM vectors WHERE id = ?", (row[0],))
+        return [row[1]] if row[1] is not None else []
+
+    def update(self, added: Iterable[Tuple[str, str, Sequence[float]]] = (), removed: Iterable[str] = ()):
+        # Inserts or replaces (issue_key, summary, vector) entries and removes issue keys, in one transaction
+        added = list({issue_key: (issue_key, summary, vector) for issue_key, summary, vector in added}.values())
+        with self._lock:
+            released, written = [], []
+            try:
+                for issue_key in removed:
+                    released.extend(self._delete(issue_key))
+                for issue_key, summary, vector in added:
+                    vector = np.asarray(vector, dtype=np.float32)
+                    if vector.shape != (self.dim,):
+                        raise ValueError(f"Vector of issue {issue_key} has shape {vector.shape}, not ({self.dim},)")
+                    released.extend(self._delete(issue_key))
+                    # Rows released in this transaction are only reused once it has committed
+                    matrix_row = self._allocate()
+                    self._matrix[matrix_row] = vector
+                    self._conn.execute(
+                        "INSERT INTO vectors (issue_key, summary, vector, matrix_row) VALUES (?, ?, ?, ?)",
+                        (issue_key, summary, vector.tobytes(), matrix_row)
+                    )
+                    written.append((matrix_row, issue_key))
+                self._matrix.flush()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                self._free.extend(matrix_row for matrix_row, _ in written)
+                raise
+            for matrix_row in released:
+                self._keys[matrix_row] = None
+                self._live[matrix_row] = False
+                self._free.append(matrix_row)
+            if written:
+                rows = [matrix_row for matrix_row, _ in written]
+                for matrix_row, issue_key in written:
+                    self._keys[matrix_row] = issue_key
+                self._live[rows] = True
+                self._codes[rows] = self._sketch(self._matrix[rows])
+
+    def add(self, issue_key: str, summary: str, vector: Sequence[float]):
+        self.update(added=[(issue_key, summary, vector)])
+
+    def remove(self, issue_key: str):
+        self.update(removed=[issue_key])
+
+    def recall(self, similarity: float = SIMILARITY_THRESHOLD) -> float:
+        # Probability that an issue at this similarity is scored by a lookup with that threshold
+        bits = self._planes.shape[0]
+        return sketch_recall(similarity, sketch_radius(similarity, bits), bits)
+
+    def nearest(self, vector: Sequence[float], threshold=SIMILARITY_THRESHOLD) -> Optional[Tuple[str, float]]:
+        # (issue_key, cosine similarity) of the most similar indexed issue above threshold, else None
+        query = np.asarray(vector, dtype=np.float32)
+        code = self._sketch(query[None, :])[0]
+        radius = sketch_radius(threshold, self._planes.shape[0])
+        with self._lock:
+            high = self._high
+            distances = _POPCOUNT[np.bitwise_xor(self._codes[:high], code)].sum(axis=1)
+            candidates = np.flatnonzero((distances <= radius) & self._live[:high])
+            self.last_candidates = len(candidates)
+            if not len(candidates):
+                return None
+            scores = self._matrix[candidates] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < threshold:
+                return None
+            return self._keys[int(candidates[best])], float(scores[best])
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._matrix is not None:
+                self._matrix.flush()
+                self._matrix = None
+            self._conn.close()
+
+
+class ComplaintCluster:
+    def __init__(self, leader: Complaint, vector: List[float], existing_issue: Optional[str] = None):
+        self.leader = leader
+        self.vector = vector
+        self.members: List[Complaint] = [leader]
+        self.existing_issue = existing_issue
+
+    @property
+    def comment_ids(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(member.comment_id for member in self.members))
+
+
+# Groups near-duplicate complaints of a run into clusters, and matches each cluster against the
+# persistent index of existing issues, so that one complaint reported by many users yields one ticket
+# (or one comment on the issue that already tracks it) instead of one ticket per comment.
+class ComplaintClusterer:
+    def __init__(self, index: ComplaintIndex, embedder=None, threshold=SIMILARITY_THRESHOLD):
+        self.index = index
+        self.embedder = embedder or HashingEmbedder(index.dim)
+        self.threshold = threshold
+
+    def cluster(self, complaints: Sequence[Complaint]) -> List[ComplaintCluster]:
+        if not complaints:
+            return []
+        vectors = self.embedder.embed([complaint.text for complaint in complaints])
+        clusters: List[ComplaintCluster] = []
+        by_issue: Dict[str, ComplaintCluster] = {}
+        # The clusters of this run are few compared to the persisted backlog, so they are scanned directly
+        for complaint, vector in zip(complaints, vectors):
+            match = self.index.nearest(vector, self.threshold)
+            if match is not None:
+                issue_key = match[0]
+                if issue_key in by_issue:
+                    by_issue[issue_key].members.append(complaint)
+                else:
+                    by_issue[issue_key] = ComplaintCluster(complaint, vector, existing_issue=issue_key)
+                    clusters.append(by_issue[issue_key])
+                continue
+            best, best_similarity = None, self.threshold
+            for cluster in clusters:
+                if cluster.existing_issue is None:
+                    similarity = _dot(vector, cluster.vector)
+                    if similarity >= best_similarity:
+                        best, best_similarity = cluster, similarity
+            if best is not None:
+                best.members.append(complaint)
+            else:
+                clusters.append(ComplaintCluster(complaint, vector))
+        logger.debug(f'{len(complaints)} complaints grouped into {len(clusters)} clusters, '
+                     f'{len(by_issue)} of them matching existing issues')
+        return clusters
+
+    def add_issue(self, issue_key: str, summary: str, vector: Optional[Sequence[float]] = None):
+        self.index.add(issue_key, summary, vector if vector is not None else self.embedder.embed([summary])[0])
+
+    def sync_issues(self, jira_client):
+        # Incrementally mirrors the project's open issues into the index: the first sync loads every open
+        # issue, later ones only fetch issues updated since the previous sync and drop the resolved ones.
+        last_sync = self.index.get_meta("last_sync")
+        started = time.time()
+        updated_within = None if last_sync is None else int((started - float(last_sync)) / 60) + 5
+        added, removed = [], []
+        total_added = total_removed = 0
+        for issue_key, summary, done in jira_client.iter_project_issues(updated_within_minutes=updated_within):
+            if done:
+                removed.append(issue_key)
+            else:
+                added.append((issue_key, summary))
+            if len(added) + len(removed) >= SYNC_BATCH_SIZE:
+                self._write_issues(added, removed)
+                total_added, total_removed = total_added + len(added), total_removed + len(removed)
+                added, removed = [], []
+        self._write_issues(added, removed)
+        total_added, total_removed = total_added + len(added), total_removed + len(removed)
+        self.index.set_meta("last_sync", str(started))
+        logger.debug(f'Synced complaint index with Jira: {total_added} issues added or updated, {total_removed} removed')
+
+    def _write_issues(self, added, removed):
+        # One embedding batch and one index transaction per SYNC_BATCH_SIZE issues
+        if not added and not removed:
+            return
+        vectors = self.embedder.embed([summary for _, summary in added]) if added else []
+        self.index.update([(issue_key, summary, vector) for (issue_key, summary), vector in zip(added, vectors)], removed)
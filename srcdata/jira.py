@@ -1,57 +1,208 @@
-import requests, json, logging, sys
+import requests, json, logging, os, sys, re, time, random, threading
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from typing import Any, Iterable, List, Optional, Set
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from srcdata import metrics
 
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
 handler = logging.StreamHandler(stream=sys.stdout)
 handler.setFormatter(formatter)
 logger = logging.getLogger('JiraClient')
 logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# Comment IDs per bulk JQL search; keeps the OR query well below URL and JQL length limits.
+SEARCH_BATCH_SIZE = 50
+SEARCH_PAGE_SIZE = 100
+
+# (connect, read) timeouts in seconds for every Jira call
+DEFAULT_TIMEOUT = (5, 30)
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Client-side throttle; Jira Cloud starts answering 429 well before this on most plans, tune per site.
+REQUESTS_PER_SECOND = 10.0
+BURST = 10
+POOL_SIZE = 10
+# /rest/api/2/issue/bulk accepts at most 50 issues per request
+BULK_CREATE_SIZE = 50
+BULK_MAX_WAIT = 5.0
+
+# Outcome of one issue in a bulk creation: `source` is whatever the caller queued the issue with
+# (e.g. the Reddit comment ID), `key` the created issue key, `error` the Jira error when it failed.
+IssueResult = namedtuple('IssueResult', ['source', 'key', 'error'])
+
+
+def _is_connect_failure(error) -> bool:
+    # True when no connection to Jira could be established, so the request was certainly not sent.
+    # Other connection errors (e.g. "Connection aborted" once the body is out) may follow a processed request.
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _field_text(value) -> str:
+    # Plain text of a Jira field, which API v3 returns as an Atlassian Document Format tree.
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return " ".join(_field_text(item) for item in value)
+    if isinstance(value, dict):
+        return " ".join([value.get("text", "")] + [_field_text(item) for item in value.get("content", [])])
+    return str(value)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def block_for(self, seconds: float):
+        # Called on a 429 so that every thread sharing the client backs off, not only the one that was throttled.
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
 
 
 class JiraClient:
-    def __init__(self, email, token, base_url, project_id, reporter_id, issue_type):
+    def __init__(self, email, token, base_url, project_id, reporter_id, issue_type,
+                 timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES,
+                 requests_per_second: Optional[float] = REQUESTS_PER_SECOND, burst=BURST, pool_size=POOL_SIZE,
+                 bulk_size=BULK_CREATE_SIZE, bulk_max_wait=BULK_MAX_WAIT):
         self.email = email
         self.token = token
         self.base_url = base_url
         self.project_id = project_id
         self.reporter_id = reporter_id
         self.issue_type = issue_type
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self.bulk_size = min(bulk_size, BULK_CREATE_SIZE)
+        self.bulk_max_wait = bulk_max_wait
+        self._pending = []
+        self._pending_since = None
+        self._pending_lock = threading.Lock()
+
+        # One keep-alive session for all calls instead of a new connection (and TLS handshake) per request
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(self.email, self.token)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _backoff(self, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _request(self, method: str, url: str, idempotent: bool = True, operation: str = "request",
+                 **kwargs) -> requests.Response:
+        # Non-idempotent calls (issue creation, comments) are only retried when the request certainly did not
+        # reach Jira: failures to connect and 429s. Everything else also retries on 5xx, dropped connections
+        # and read timeouts. The whole call, throttling and retries included, is timed as the Jira `operation`.
+        retry_statuses = RETRY_STATUSES if idempotent else {429}
+        attempt = 0
+        with metrics.external_call("jira", operation, method=method) as span:
+            while True:
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
+                try:
+                    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt >= self.max_retries or not (idempotent or _is_connect_failure(e)):
+                        raise
+                    delay = self._backoff(attempt)
+                    reason = type(e).__name__
+                    logger.warning(f'{method} {url} failed ({e}), retrying in {delay:.2f}s')
+                else:
+                    if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                        span.set_attribute("http.status_code", response.status_code)
+                        span.set_attribute("retries", attempt)
+                        return response
+                    retry_after = self._retry_after(response)
+                    delay = retry_after if retry_after is not None else self._backoff(attempt)
+                    if response.status_code == 429 and self.rate_limiter:
+                        self.rate_limiter.block_for(delay)
+                    reason = str(response.status_code)
+                    logger.warning(f'{method} {url} returned {response.status_code}, retrying in {delay:.2f}s')
+                metrics.JIRA_RETRIES.inc(operation=operation, reason=reason)
+                span.add_event("retry", reason=reason, delay=delay)
+                attempt += 1
+                time.sleep(delay)
+
+    def _issue_fields(self, summary: str, description: str, priority: str):
+        return {
+            "description": description,
+            "issuetype": {
+                "id": f"{self.issue_type}"
+            },
+            "labels": [
+                "bugfix",
+            ],
+            "project": {
+                "id": f"{self.project_id}"
+            },
+            "reporter": {
+                "id": f"{self.reporter_id}"
+            },
+            "summary": summary,
+            "priority": {
+                "name": priority
+            }
+        }
 
     def create_issue(self, summary: str, description: str, priority: str):
         try:
             url = f"{self.base_url}/rest/api/2/issue"
             logger.debug(f'Jira URL: {url}')
-            auth = HTTPBasicAuth(self.email, self.token)
-            headers = {
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            }
 
             payload = json.dumps({
-                "fields": {
-                    "description": description,
-                    "issuetype": {
-                        "id": f"{self.issue_type}"
-                    },
-                    "labels": [
-                        "bugfix",
-                    ],
-                    "project": {
-                        "id": f"{self.project_id}"
-                    },
-                    "reporter": {
-                        "id": f"{self.reporter_id}"
-                    },
-                    "summary": summary,
-                    "priority": {
-                        "name": priority
-                    }
-                }
+                "fields": self._issue_fields(summary, description, priority)
             })
             logger.debug(payload)
 
-            response = requests.post(url, data=payload, headers=headers, auth=auth)
+            response = self._request("POST", url, idempotent=False, operation="create", data=payload)
             response.raise_for_status()
             #print(response.content)
         except requests.RequestException as e:
@@ -59,15 +210,127 @@ class JiraClient:
             raise(e)
         #    print(f"Error: {e}")
 
+    def queue_issue(self, summary: str, description: str, priority: str, source: Any = None) -> List[IssueResult]:
+        # Buffers the issue for bulk creation. The buffer is flushed once it holds bulk_size issues or
+        # its oldest issue waited bulk_max_wait seconds; the results of that flush are returned
+        # (an empty list otherwise). Call flush() at the end of a run for the remainder.
+        with self._pending_lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append((summary, description, priority, source))
+            due = len(self._pending) >= self.bulk_size or time.monotonic() - self._pending_since >= self.bulk_max_wait
+            if not due:
+                return []
+            batch, self._pending = self._pending, []
+        return self.create_issues(batch)
+
+    def flush(self) -> List[IssueResult]:
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+        return self.create_issues(batch)
+
+    def create_issues(self, issues: Iterable[tuple]) -> List[IssueResult]:
+        # issues: (summary, description, priority, source) tuples; one IssueResult per issue, in order.
+        issues = list(issues)
+        results = []
+        for start in range(0, len(issues), self.bulk_size):
+            results.extend(self._create_bulk(issues[start:start + self.bulk_size]))
+        return results
+
+    def _create_bulk(self, issues: List[tuple]) -> List[IssueResult]:
+        url = f"{self.base_url}/rest/api/2/issue/bulk"
+        logger.debug(f'Jira URL: {url}, creating {len(issues)} issues')
+        payload = json.dumps({
+            "issueUpdates": [
+                {"fields": self._issue_fields(summary, description, priority)}
+                for summary, description, priority, _ in issues
+            ]
+        })
+        try:
+            response = self._request("POST", url, idempotent=False, operation="bulk_create", data=payload)
+            # Jira answers 201 when all issues were created and 400 when some (or all) of them failed;
+            # in both cases the body lists the created issues in order and the failures by position.
+            if response.status_code not in (201, 400):
+                response.raise_for_status()
+            body = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f'Error occured at bulk Jira ticket creation: {e}')
+            return [IssueResult(source, None, f"{e}") for _, _, _, source in issues]
+
+        errors = {}
+        for error in body.get('errors', []):
+            element_errors = error.get('elementErrors', {})
+            message = "; ".join(
+                element_errors.get('errorMessages', []) +
+                [f"{field}: {text}" for field, text in element_errors.get('errors', {}).items()]
+            )
+            errors[error.get('failedElementNumber')] = message or f"HTTP {error.get('status')}"
+        created = iter(body.get('issues', []))
+        results = []
+        for position, (_, _, _, source) in enumerate(issues):
+            if position in errors:
+                results.append(IssueResult(source, None, errors[position]))
+                continue
+            issue = next(created, None)
+            if issue is None:
+                results.append(IssueResult(source, None, f"HTTP {response.status_code}: issue missing from response"))
+            else:
+                results.append(IssueResult(source, issue.get('key'), None))
+        failed = sum(1 for result in results if result.error)
+        if failed:
+            logger.error(f'{failed} of {len(issues)} Jira tickets could not be created')
+        return results
+
+    def add_comment(self, issue_key: str, body: str):
+        try:
+            url = f"{self.base_url}/rest/api/2/issue/{issue_key}/comment"
+            logger.debug(f'Jira URL: {url}')
+            response = self._request("POST", url, idempotent=False, operation="comment",
+                                     data=json.dumps({"body": body}))
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.error(f'Error at adding a comment to Jira issue {issue_key}: {e}')
+            raise(e)
+
+    def iter_project_issues(self, updated_within_minutes: Optional[int] = None):
+        # Yields (issue_key, summary, done) for the project's issues: all open ones, or, with
+        # updated_within_minutes, every issue updated in that window so callers can drop resolved ones.
+        url = f"{self.base_url}/rest/api/3/search"
+        if updated_within_minutes is None:
+            jql = f'project = {self.project_id} AND statusCategory != Done'
+        else:
+            jql = f'project = {self.project_id} AND updated >= -{updated_within_minutes}m'
+        start_at = 0
+        while True:
+            query = {
+                'jql': jql,
+                'startAt': start_at,
+                'maxResults': SEARCH_PAGE_SIZE,
+                "fields": [
+                    "summary",
+                    "status"
+                ],
+            }
+            try:
+                response = self._request("GET", url, operation="list_issues", params=query)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                logger.error(f'Error at listing Jira issues of project {self.project_id}: {e}')
+                raise(e)
+            result = response.json()
+            issues = result.get('issues', [])
+            for issue in issues:
+                fields = issue.get('fields', {})
+                category = fields.get('status', {}).get('statusCategory', {}).get('key')
+                yield issue['key'], _field_text(fields.get('summary')), category == 'done'
+            start_at += len(issues)
+            if len(issues) == 0 or start_at >= result.get('total', 0):
+                return
+
     def search_issue(self, comment_id):
         try:
             url = f"{self.base_url}/rest/api/3/search"
             logger.debug(f'Jira URL: {url}')
-            auth = HTTPBasicAuth(self.email, self.token)
-            headers = {
-                "Accept": "application/json",
-                "Content-Type": "application/json"
-            }
 
             query = {
                 'jql': f'description ~ {comment_id}',
@@ -81,17 +344,58 @@ class JiraClient:
                 ],
             }
 
-            logger.debug(f'Request payload: {json.dumps(obj=query, indent=4)}')
-            response = requests.request(
-                "GET",
-                url,
-                headers=headers,
-                params=query,
-                auth=auth
-            )
-            logger.debug(f'Search Jira issue response: {json.dumps(obj=response.json(), indent=4)}')
+            # Payloads are only serialized when DEBUG output is enabled
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Request payload: {json.dumps(obj=query, indent=4)}')
+            response = self._request("GET", url, operation="search", params=query)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Search Jira issue response: {json.dumps(obj=response.json(), indent=4)}')
             response.raise_for_status()
             return response.json().get('issues', [])
         except requests.RequestException as e:
             logger.error(f'Error at searching Jira issue for comment ID {comment_id}: {e}')
             raise(e)
+
+    def find_ticketed_comments(self, comment_ids: Iterable[str]) -> Set[str]:
+        # Bulk counterpart of search_issue: a single JQL query (paged) for up to SEARCH_BATCH_SIZE
+        # comment IDs. Returns the IDs that are referenced in the description of an existing issue, or in one
+        # of its comments (complaints attached to an existing issue, see RedditAnalyzer.attach_to_issue).
+        comment_ids = list(comment_ids)
+        if not comment_ids:
+            return set()
+        try:
+            url = f"{self.base_url}/rest/api/3/search"
+            logger.debug(f'Jira URL: {url}')
+            jql = " OR ".join(f'description ~ "{comment_id}" OR comment ~ "{comment_id}"' for comment_id in comment_ids)
+
+            found = set()
+            start_at = 0
+            while True:
+                query = {
+                    'jql': jql,
+                    'startAt': start_at,
+                    'maxResults': SEARCH_PAGE_SIZE,
+                    "fields": [
+                        "description",
+                        "comment"
+                    ],
+                }
+                response = self._request("GET", url, operation="search", params=query)
+                response.raise_for_status()
+                result = response.json()
+                issues = result.get('issues', [])
+                for issue in issues:
+                    # The text search is fuzzy, so confirm which IDs the description or comments really contain.
+                    fields = issue.get('fields', {})
+                    comments = (fields.get('comment') or {}).get('comments', [])
+                    text = " ".join([_field_text(fields.get('description'))] + [_field_text(comment.get('body')) for comment in comments])
+                    words = set(re.findall(r"\w+", text))
+                    found.update(comment_id for comment_id in comment_ids if comment_id in words)
+                start_at += len(issues)
+                if len(issues) == 0 or start_at >= result.get('total', 0):
+                    break
+            logger.debug(f'{len(found)} of {len(comment_ids)} comments already have a Jira issue')
+            return found
+        except requests.RequestException as e:
+            logger.error(f'Error at bulk searching Jira issues for {len(comment_ids)} comments: {e}')
+            raise(e)
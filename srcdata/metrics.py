@@ -0,0 +1,321 @@
+import bisect, contextvars, json, logging, os, secrets, sys, threading, time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Sequence, Tuple
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(formatter)
+logger = logging.getLogger('Metrics')
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# Upper bounds in seconds of the latency histogram buckets, from a local cache hit to a slow Azure poll
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            lines.extend(f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(self._values.items()))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [count per bucket (+Inf last), sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key][1] = total + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            values = self._values.get(_label_key(labels))
+            return sum(values[0]) if values else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(key, (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {type(metric).__name__}")
+            return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._get(Counter, name, documentation)
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, documentation, buckets=buckets)
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def write(self, path: str):
+        # Atomic, so a scraper (e.g. the node_exporter textfile collector) never reads a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info(f'Serving Prometheus metrics on http://{host}:{server.server_port}/metrics')
+        return server
+
+
+# Spans follow the OpenTelemetry data model (trace/span/parent IDs, attributes, events, status) and are
+# exported as one JSON object per line. Without an exporter, tracing is a no-op.
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_span_id", "start_time_unix_nano",
+                 "end_time_unix_nano", "attributes", "events", "status")
+
+    def __init__(self, tracer, name: str, parent: Optional["Span"], attributes: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else None
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano = None
+        self.attributes = dict(attributes)
+        self.events = []
+        self.status = {"code": "UNSET"}
+
+    def set_attribute(self, name: str, value):
+        self.attributes[name] = value
+
+    def add_event(self, name: str, **attributes):
+        self.events.append({"name": name, "time_unix_nano": time.time_ns(), "attributes": attributes})
+
+    def end(self, error: Optional[str] = None):
+        if self.end_time_unix_nano is not None:
+            return
+        self.end_time_unix_nano = time.time_ns()
+        self.status = {"code": "ERROR", "message": error} if error else {"code": "OK"}
+        self.tracer.export(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_time_unix_nano,
+            "end_time_unix_nano": self.end_time_unix_nano,
+            "attributes": self.attributes,
+            "events": self.events,
+            "status": self.status,
+        }
+
+
+class _NoopSpan:
+    trace_id = span_id = parent_span_id = None
+
+    def set_attribute(self, name, value):
+        pass
+
+    def add_event(self, name, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class SpanFileExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Tracer:
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def current_span(self):
+        return _current_span.get()
+
+    def start_span(self, name: str, parent=None, **attributes):
+        # parent defaults to the current span; the new span does not become the current one
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = parent if parent is not None else _current_span.get()
+        return Span(self, name, parent if isinstance(parent, Span) else None, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        # Span around a block, current for the block (and for threads started with asyncio.to_thread from it)
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span) if span is not NOOP_SPAN else None
+        try:
+            yield span
+        except BaseException as e:
+            span.end(error=f"{type(e).__name__}: {e}")
+            raise
+        else:
+            span.end()
+        finally:
+            if token is not None:
+                _current_span.reset(token)
+
+    def export(self, span: Span):
+        if self.exporter is not None:
+            self.exporter.export(span)
+
+
+REGISTRY = Registry()
+TRACER = Tracer()
+
+EXTERNAL_CALL_SECONDS = REGISTRY.histogram(
+    "external_call_seconds", "Duration of calls to external services (Reddit, Jira, Azure), retries included")
+COMMENTS_PROCESSED = REGISTRY.counter(
+    "reddit_comments_processed_total", "New or edited Reddit comments taken up by a run")
+COMMENTS_FILTERED = REGISTRY.counter(
+    "reddit_comments_filtered_total", "Comments dropped before ticket creation, by reason")
+COMMENTS_TICKETED = REGISTRY.counter(
+    "reddit_comments_ticketed_total", "Comments turned into a new Jira issue or attached to an existing one")
+COMMENTS_FAILED = REGISTRY.counter(
+    "reddit_comments_failed_total", "Comments left for the next run because an external call failed, by stage")
+JIRA_RETRIES = REGISTRY.counter(
+    "jira_retries_total", "Retried Jira requests, by operation and reason")
+WORK_ITEMS = REGISTRY.counter(
+    "work_queue_items_total", "Work queue items handled, by stage and result (advance, done, retried, dead_lettered)")
+
+_metrics_file = None
+
+
+@contextmanager
+def external_call(service: str, operation: str, **attributes):
+    # Times the block into EXTERNAL_CALL_SECONDS and wraps it in a "<service>.<operation>" span
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        with TRACER.span(f"{service}.{operation}", **attributes) as span:
+            yield span
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        EXTERNAL_CALL_SECONDS.observe(time.perf_counter() - start, service=service, operation=operation, outcome=outcome)
+
+
+def configure(metrics_file: Optional[str] = None, metrics_port: Optional[int] = None, trace_file: Optional[str] = None):
+    # Sets up the exports: a Prometheus text file rewritten by flush(), an HTTP endpoint, and a span file
+    global _metrics_file
+    _metrics_file = metrics_file
+    if metrics_port:
+        REGISTRY.serve(metrics_port)
+    if trace_file:
+        TRACER.exporter = SpanFileExporter(trace_file)
+
+
+def flush():
+    if _metrics_file:
+        try:
+            REGISTRY.write(_metrics_file)
+        except OSError as e:
+            logger.error(f'Error writing metrics to {_metrics_file}: {e}')
@@ -0,0 +1,167 @@
+import hashlib, logging, os, re, sys
+from collections import Counter, OrderedDict
+from typing import Dict, Optional
+
+from srcdata import metrics
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(formatter)
+logger = logging.getLogger('CommentPreFilter')
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+REMOVED_BODIES = {"[deleted]", "[removed]"}
+BOT_AUTHORS = {"automoderator"}
+BOT_SUFFIXES = ("bot",)
+MIN_LENGTH = 15
+MIN_WORDS = 3
+# Max Hamming distance between 64-bit SimHashes for two comments to count as near duplicates.
+# Must stay below SIMHASH_BANDS so that near duplicates always share at least one band.
+NEAR_DUPLICATE_DISTANCE = 6
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 8
+# Fingerprints kept for duplicate detection; the oldest comments are forgotten first, so a long-running
+# monitor does not grow without limit
+MAX_FINGERPRINTS = 100_000
+# train_pipeline_bertVersion.py --task classification labels bug reports as 1
+CLASSIFIER_NEGATIVE_LABEL = "LABEL_1"
+CLASSIFIER_THRESHOLD = 0.5
+CLASSIFIER_BATCH_SIZE = 32
+
+_WORD = re.compile(r"\w+")
+
+
+def _normalize(text: str) -> str:
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def simhash(text: str) -> int:
+    # 64-bit SimHash over word unigrams and bigrams
+    words = _WORD.findall(text.lower())
+    features = Counter(words + [f"{a} {b}" for a, b in zip(words, words[1:])])
+    weights = [0] * SIMHASH_BITS
+    for feature, count in features.items():
+        value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += count if value >> bit & 1 else -count
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+
+# Cheap local rules run before the paid Azure calls. Only comments that pass every rule (and, when a
+# classifier checkpoint is configured, look like a complaint to it) are analyzed.
+# `dropped` counts the comments removed by each rule.
+class CommentPreFilter:
+    def __init__(self, min_length=MIN_LENGTH, min_words=MIN_WORDS, bot_authors=BOT_AUTHORS, bot_suffixes=BOT_SUFFIXES,
+                 near_duplicate_distance: Optional[int] = NEAR_DUPLICATE_DISTANCE, classifier_path: Optional[str] = None,
+                 classifier_threshold=CLASSIFIER_THRESHOLD, classifier_negative_label=CLASSIFIER_NEGATIVE_LABEL,
+                 max_fingerprints=MAX_FINGERPRINTS):
+        self.min_length = min_length
+        self.min_words = min_words
+        self.bot_authors = {author.lower() for author in bot_authors}
+        self.bot_suffixes = tuple(suffix.lower() for suffix in bot_suffixes)
+        self.near_duplicate_distance = near_duplicate_distance
+        self.classifier_threshold = classifier_threshold
+        self.classifier_negative_label = classifier_negative_label
+        self.classifier = None
+        if classifier_path:
+            from transformers import pipeline
+            self.classifier = pipeline("text-classification", model=classifier_path, tokenizer=classifier_path)
+        self.dropped: Counter = Counter()
+        self.passed = 0
+        self.max_fingerprints = max_fingerprints
+        # Fingerprints are keyed by comment ID: a comment seen again (e.g. retried after a failed batch)
+        # is not a duplicate of itself
+        self._exact: Dict[str, str] = {}
+        self._bands: Dict[tuple, Dict[str, int]] = {}
+        self._fingerprints: "OrderedDict[str, tuple]" = OrderedDict()
+        self._band_bits = SIMHASH_BITS // SIMHASH_BANDS
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.dropped, passed=self.passed)
+
+    def filter(self, comments) -> list:
+        kept = []
+        for comment in comments:
+            rule = self._dropping_rule(comment)
+            if rule:
+                self.dropped[rule] += 1
+                metrics.COMMENTS_FILTERED.inc(reason=rule)
+            else:
+                kept.append(comment)
+        if self.classifier is not None and kept:
+            kept = self._classify(kept)
+        self.passed += len(kept)
+        logger.debug(f'Pre-filter kept {len(kept)} of {len(comments)} comments, totals: {self.stats()}')
+        return kept
+
+    def _dropping_rule(self, comment) -> Optional[str]:
+        body = (comment.body or "").strip()
+        if body in REMOVED_BODIES:
+            return "removed"
+        author = getattr(comment, "author", None)
+        name = (getattr(author, "name", None) or "").lower()
+        if name and (name in self.bot_authors or name.endswith(self.bot_suffixes)):
+            return "bot"
+        if len(body) < self.min_length or len(_WORD.findall(body)) < self.min_words:
+            return "too_short"
+        normalized = _normalize(body)
+        if self._exact.get(normalized, comment.id) != comment.id:
+            return "duplicate"
+        value = keys = None
+        if self.near_duplicate_distance is not None:
+            value = simhash(body)
+            keys = self._band_keys(value)
+            if self._is_near_duplicate(comment.id, value, keys):
+                return "near_duplicate"
+        self._remember(comment.id, normalized, value, keys)
+        return None
+
+    def _band_keys(self, value: int) -> list:
+        # Split into SIMHASH_BANDS bands; by pigeonhole, hashes within NEAR_DUPLICATE_DISTANCE bits share a band
+        mask = (1 << self._band_bits) - 1
+        return [(band, value >> (band * self._band_bits) & mask) for band in range(SIMHASH_BANDS)]
+
+    def _is_near_duplicate(self, comment_id: str, value: int, keys) -> bool:
+        for key in keys:
+            for other_id, other in self._bands.get(key, {}).items():
+                if other_id != comment_id and bin(value ^ other).count("1") <= self.near_duplicate_distance:
+                    return True
+        return False
+
+    def _remember(self, comment_id: str, normalized: str, value: Optional[int], keys):
+        # An edited comment replaces the fingerprints of its previous version
+        self._forget(comment_id)
+        self._exact[normalized] = comment_id
+        for key in keys or ():
+            self._bands.setdefault(key, {})[comment_id] = value
+        self._fingerprints[comment_id] = (normalized, keys)
+        while len(self._fingerprints) > self.max_fingerprints:
+            self._forget(next(iter(self._fingerprints)))
+
+    def _forget(self, comment_id: str):
+        fingerprint = self._fingerprints.pop(comment_id, None)
+        if fingerprint is None:
+            return
+        normalized, keys = fingerprint
+        if self._exact.get(normalized) == comment_id:
+            del self._exact[normalized]
+        for key in keys or ():
+            band = self._bands.get(key)
+            if band is not None:
+                band.pop(comment_id, None)
+                if not band:
+                    del self._bands[key]
+
+    def _classify(self, comments) -> list:
+        predictions = self.classifier([comment.body for comment in comments], batch_size=CLASSIFIER_BATCH_SIZE,
+                                      truncation=True, top_k=None)
+        kept = []
+        for comment, scores in zip(comments, predictions):
+            score = next((item["score"] for item in scores if item["label"] == self.classifier_negative_label), 0.0)
+            if score >= self.classifier_threshold:
+                kept.append(comment)
+            else:
+                self.dropped["classifier"] += 1
+                metrics.COMMENTS_FILTERED.inc(reason="classifier")
+        return kept
@@ -6,10 +6,17 @@ from typing import Dict, Any
 from azure.core.exceptions import AzureError
 from praw.exceptions import PRAWException
 from praw.models import Submission
-import sys, os, logging, json
+from prawcore.exceptions import PrawcoreException
+import sys, os, logging, json, asyncio, time, heapq, threading
+from collections import deque
+from types import SimpleNamespace
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from script import jira
+from srcdata import jira, metrics
+from srcdata.state import StateStore, DEFAULT_STATE_PATH
+from srcdata.prefilter import CommentPreFilter
+from srcdata.clustering import Complaint, ComplaintClusterer, ComplaintIndex, DEFAULT_INDEX_PATH
+from srcdata.work_queue import WorkQueue, DEFAULT_QUEUE_PATH, STAGES
 
 
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
@@ -17,11 +24,90 @@ handler = logging.StreamHandler(stream=sys.stdout)
 handler.setFormatter(formatter)
 logger = logging.getLogger('RedditAnalyzer')
 logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+# Languages supported by Azure AI Language abstract summarization
+SUMMARY_LANGUAGES = ["en", "es", "de", "ko", "ja", "it", "fr", "pt", "zh", "he", "pl"]
+# Documents per request, as limited by the Azure AI Language service
+LANGUAGE_BATCH_SIZE = 1000
+SENTIMENT_BATCH_SIZE = 10
+SUMMARY_BATCH_SIZE = 25
+
+# Async pipeline (search_reddits_async): bounded queue size between stages, number of
+# MoreComments expanded per Reddit fetch step, and concurrent calls allowed per external service (plus
+# the local pre-filter, which may run a classifier and keeps shared duplicate state, so one call at a time)
+PIPELINE_QUEUE_SIZE = 8
+REPLACE_MORE_STEP = 32
+# Runs after the first one read the subreddit's comment listing back to the watermark, minus this many seconds
+# for comments that show up in the listing late
+WATERMARK_OVERLAP = 300
+SERVICE_CONCURRENCY = {"reddit": 1, "jira": 4, "azure": 4, "prefilter": 1}
+_STAGE_DONE = object()
+# PRAW raises its own errors, while HTTP failures (5xx, throttling, unknown subreddit, ...) come from prawcore
+REDDIT_ERRORS = (PRAWException, PrawcoreException)
+
+# Monitor mode: per-submission poll interval bounds in seconds (halved after a poll that found new
+# comments, doubled after an idle one), how often subreddits are scanned for hot submissions, and how many
+# hot submissions are picked up per subreddit
+MIN_POLL_INTERVAL = 60
+MAX_POLL_INTERVAL = 3600
+DISCOVERY_INTERVAL = 600
+SUBREDDIT_HOT_LIMIT = 25
+
+# Work queue mode: comments claimed per stage batch, and how long a run waits in total for failed items
+# to come due for a retry before leaving them to the next run
+QUEUE_BATCH_SIZE = jira.SEARCH_BATCH_SIZE
+QUEUE_MAX_WAIT = 120
+# Errors kept for the notification email; older ones are dropped first
+EMAIL_MAX_ENTRIES = 500
+
+
+def _comment_from_fields(fields):
+    # Stand-in for the PRAW comment stored in a work item (see WorkQueue.comment_fields)
+    author = SimpleNamespace(name=fields["author"]) if fields.get("author") else None
+    return SimpleNamespace(id=fields["id"], body=fields["body"], author=author,
+                           created_utc=fields["created_utc"], edited=fields["edited"])
+
+
+def _analysis_to_dict(analysis_document):
+    # The parts of an Azure sentiment result used by create_tickets, as JSON
+    return {
+        "sentiment": analysis_document.sentiment,
+        "sentences": [
+            [
+                {
+                    "target": mined_opinion.target.text,
+                    "sentiment": mined_opinion.target.sentiment,
+                    "assessments": [assessment.text for assessment in mined_opinion.assessments],
+                }
+                for mined_opinion in (sentence.mined_opinions or [])
+            ]
+            for sentence in analysis_document.sentences
+        ],
+    }
+
+
+def _analysis_from_dict(analysis):
+    return SimpleNamespace(
+        is_error=False,
+        sentiment=analysis["sentiment"],
+        sentences=[
+            SimpleNamespace(mined_opinions=[
+                SimpleNamespace(
+                    target=SimpleNamespace(text=opinion["target"], sentiment=opinion["sentiment"]),
+                    assessments=[SimpleNamespace(text=text) for text in opinion["assessments"]],
+                )
+                for opinion in sentence
+            ])
+            for sentence in analysis["sentences"]
+        ],
+    )
+
 
 class RedditAnalyzer:
     def __init__(self, client_id, client_secret, password, user_agent, 
-                 username, endpoint, key, jira_email, jira_token, base_url, project_id, reporter_id, issue_type):
+                 username, endpoint, key, jira_email, jira_token, base_url, project_id, reporter_id, issue_type,
+                 state_path=DEFAULT_STATE_PATH, prefilter=None, clusterer=None, work_queue=None):
         self.reddit = Reddit(
             client_id=client_id,
             client_secret=client_secret,
@@ -31,37 +117,48 @@ class RedditAnalyzer:
         )
         self.text_analytics_client = TextAnalyticsClient(endpoint, AzureKeyCredential(key))
         self.jira_client = jira.JiraClient(jira_email, jira_token, base_url, project_id, reporter_id, issue_type)
-        self.email_content = []
+        self.state = StateStore(state_path)
+        self.prefilter = prefilter or CommentPreFilter()
+        self.clusterer = clusterer or ComplaintClusterer(ComplaintIndex(DEFAULT_INDEX_PATH))
+        # Complaints collected during a run; flush_tickets() clusters them into tickets
+        self.pending_complaints = []
+        self._complaints_lock = threading.Lock()
+        # Durable per-comment queue (see WorkQueue); without one, a run processes its comments in memory
+        self.work_queue = work_queue
+        self.email_content = deque(maxlen=EMAIL_MAX_ENTRIES)
+        # Comments whose batch failed in this run; they are not recorded as seen so the next run retries them
+        self.failed_comment_ids = set()
+        # Error of each failed comment, used by the work queue to tell transient failures from permanent ones
+        self.failures = {}
+        # Open "comment" spans (only when tracing is enabled), ended by record_processed
+        self._comment_spans = {}
 
 
     def search_reddits(self, submission_id: str):
         try:
-            submission: Submission = self.reddit.submission(submission_id)
-            submission.comments.replace_more(limit=None)
-            print(f"{len(submission.comments.list())} comments")
-            logger.debug(f"{len(submission.comments.list())} comments")
-            documents = []
-            for index, comment in enumerate(submission.comments.list()):
-                try:
-                    existing_issue = self.jira_client.search_issue(comment.id)
-                    logger.debug(f'Existing issue: {existing_issue}')
-                    if len(existing_issue) == 0:
-                        documents.append(comment)
-                except Exception as e:
-                    logger.error(f'Error searching Jira tichet for comment {comment.id}: {e}')
-                    self.email_content.extend({
-                        "Cause": f"Searching Jira for comment {comment.id}",
-                        "Message": f"{e}"
-                    })
-                    continue 
-               
+            with metrics.TRACER.span("search_reddits", submission_id=submission_id):
+                if self.work_queue is not None:
+                    self._search_reddits_queued([submission_id], QUEUE_MAX_WAIT)
+                else:
+                    self._search_reddits(submission_id)
+        finally:
+            metrics.flush()
+
+
+    def _search_reddits(self, submission_id: str):
+        self.start_run()
+        try:
+            comments = self.fetch_new_comments(submission_id)
+            documents = self.filter_unticketed(comments)
             logger.debug(f"Documents length: {len(documents)}")
 
-            for document in documents:
-                self.analyze_comment(document)
+            self.analyze_comments(documents)
+            self.flush_tickets()
+            logger.info(f"Pre-filter counts: {self.prefilter.stats()}")
+            self.record_processed(submission_id, comments)
 
             #self.send_email_notification()
-        except PRAWException as e:
+        except REDDIT_ERRORS as e:
             logger.error(f'Reddit API error: {e}')
             self.email_content.append({
                 "Cause": "Reddit API Error",
@@ -87,91 +184,769 @@ class RedditAnalyzer:
             raise(e)
 
 
-    def analyze_comment(self, comment):
+    async def search_reddits_async(self, submission_id: str, queue_size=PIPELINE_QUEUE_SIZE, concurrency=None):
+        # Same work as search_reddits, run as connected stages so that Reddit, Jira and Azure I/O overlap:
+        # fetch -> Jira dedupe -> language + sentiment -> summarization -> ticket creation.
+        # Stages exchange comment batches through bounded queues (backpressure), and each external
+        # service has its own limit on concurrent calls, shared by all stages that use it.
+        if self.work_queue is not None:
+            logger.warning('The async pipeline does not use the work queue; comments are processed in memory')
         try:
-            biggest_confidence_score = 0
-            primary_language = "en"
-            language_detection = self.text_analytics_client.detect_language(documents=[comment.body])
-            for item in language_detection:
-                logger.debug(f"Item: error: {item.is_error}, confidence score: {item.primary_language.confidence_score}, language: {item.primary_language.name}")
-                if not item.is_error and item.primary_language.confidence_score > biggest_confidence_score:
-                    logger.debug("Confidence score bigger, updating primary language")
-                    biggest_confidence_score = item.primary_language.confidence_score
-                    primary_language = item.primary_language.iso6391_name
-            logger.debug(f"Primary language of the comment in ISO format: {primary_language} with confidence score: {biggest_confidence_score}")
-            if not primary_language in ["en", "es", "de", "ko", "ja", "it", "fr", "pt", "zh", "he", "pl"]:
-                logger.error(f"Comment language: {primary_language} not support by Azure AI Language service for abstract summarization")
+            with metrics.TRACER.span("search_reddits_async", submission_id=submission_id):
+                await self._search_reddits_async(submission_id, queue_size, concurrency)
+        finally:
+            metrics.flush()
+
+
+    async def _search_reddits_async(self, submission_id: str, queue_size, concurrency):
+        self.start_run()
+        limits = dict(SERVICE_CONCURRENCY, **(concurrency or {}))
+        semaphores = {service: asyncio.Semaphore(limit) for service, limit in limits.items()}
+
+        async def call(service, fn, *args):
+            async with semaphores[service]:
+                return await asyncio.to_thread(fn, *args)
+
+        async def dedupe(comments):
+            return await call("jira", self.filter_unticketed, comments)
+
+        async def sentiment(comments):
+            # Off the event loop: with a classifier configured this is model inference
+            comments = await call("prefilter", self.prefilter_comments, comments)
+            if not comments:
+                return []
+            detected = await call("azure", self.detect_languages, comments)
+            return await call("azure", self.analyze_sentiments, detected)
+
+        async def summarize(negative):
+            return await call("azure", self.summarize_comments, negative)
+
+        async def ticket(summarized):
+            # Only collects complaints; they are clustered and sent to Jira once the run is complete
+            for comment, primary_language, analysis_document, summary_message in summarized:
+                self.create_tickets(comment, analysis_document, summary_message)
+
+        stages = [(dedupe, limits["jira"]), (sentiment, limits["azure"]), (summarize, limits["azure"]), (ticket, limits["jira"])]
+        queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+
+        fetched = []
+
+        async def push(batch):
+            fetched.extend(batch)
+            for start in range(0, len(batch), jira.SEARCH_BATCH_SIZE):
+                await queues[0].put(batch[start:start + jira.SEARCH_BATCH_SIZE])
+
+        async def fetch():
+            if self.state.get_watermark(submission_id) is not None:
+                # Incremental run: the new comments are few, fetch them in one go
+                await push(await call("reddit", self.fetch_new_comments, submission_id))
+            else:
+                async for batch in self._iter_fetch_steps(call, submission_id):
+                    await push(batch)
+            logger.debug(f"{len(fetched)} comments")
+            for _ in range(stages[0][1]):
+                await queues[0].put(_STAGE_DONE)
+
+        async def run_stage(index):
+            handler, workers = stages[index]
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+
+            async def worker():
+                while True:
+                    batch = await inbox.get()
+                    if batch is _STAGE_DONE:
+                        return
+                    try:
+                        result = await handler(batch)
+                    except Exception as e:
+                        logger.error(f'Error in pipeline stage {handler.__name__}: {e}')
+                        # Later stages carry tuples starting with the comment
+                        comment_ids = [(item[0] if isinstance(item, tuple) else item).id for item in batch]
+                        self.mark_failed([comment_id for comment_id in comment_ids if comment_id not in self.failed_comment_ids],
+                                         handler.__name__, e)
+                        self.email_content.append({
+                            "Cause": f"Error in pipeline stage {handler.__name__}",
+                            "Message": f"{e}"
+                        })
+                        continue
+                    if outbox is not None and result:
+                        await outbox.put(result)
+
+            await asyncio.gather(*(worker() for _ in range(workers)))
+            if outbox is not None:
+                for _ in range(stages[index + 1][1]):
+                    await outbox.put(_STAGE_DONE)
+
+        try:
+            await asyncio.gather(fetch(), *(run_stage(index) for index in range(len(stages))))
+            await call("jira", self.flush_tickets)
+            logger.info(f"Pre-filter counts: {self.prefilter.stats()}")
+            self.record_processed(submission_id, fetched)
+        except REDDIT_ERRORS as e:
+            logger.error(f'Reddit API error: {e}')
+            self.email_content.append({
+                "Cause": "Reddit API Error",
+                "Message": f"{e}"
+            })
+            raise(e)
+        except Exception as e:
+            logger.error(f'Unexpected error at Reddit data processing: {e}')
+            self.email_content.append({
+                "Cause": "Unexpected error at Reddit data processing",
+                "Message": f"{e}"
+            })
+            raise(e)
+
+
+    def monitor(self, submission_ids=(), subreddits=(), min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                discovery_interval=DISCOVERY_INTERVAL, hot_limit=SUBREDDIT_HOT_LIMIT, max_cycles=None):
+        # Long-running mode watching many submissions with this one set of clients. Submissions come from
+        # submission_ids and from the hot listing of each subreddit (rescanned every discovery_interval).
+        # Each submission has its own poll interval, so active threads are polled more often than idle ones,
+        # and every cycle feeds the new comments of all due submissions through one shared analysis pass.
+        # Discovered submissions that dropped out of the hot listing are unwatched once they have gone idle
+        # (polled at max_interval without new comments); the given submission_ids are watched for good.
+        intervals = {}
+        schedule = []
+        pinned = set(submission_ids)
+        hot = set()
+
+        def add(submission_id, due):
+            if submission_id not in intervals:
+                intervals[submission_id] = min_interval
+                heapq.heappush(schedule, (due, submission_id))
+
+        for submission_id in submission_ids:
+            add(submission_id, time.monotonic())
+        next_discovery = time.monotonic()
+        cycles = 0
+        while max_cycles is None or cycles < max_cycles:
+            now = time.monotonic()
+            if subreddits and now >= next_discovery:
+                discovered = self.discover_submissions(subreddits, hot_limit)
+                # A failed listing keeps the previous hot set rather than unwatching everything
+                if discovered:
+                    hot = set(discovered)
+                for submission_id in discovered:
+                    add(submission_id, now)
+                next_discovery = now + discovery_interval
+            due = []
+            while schedule and schedule[0][0] <= now:
+                due.append(heapq.heappop(schedule)[1])
+            if due:
+                try:
+                    new_counts = self.process_submissions(due)
+                except Exception as e:
+                    # One bad cycle must not end the monitor; its submissions are polled again next time
+                    logger.error(f'Error in monitor cycle {cycles}: {e}')
+                    self.email_content.append({
+                        "Cause": f"Error in monitor cycle {cycles}",
+                        "Message": f"{e}"
+                    })
+                    new_counts = {}
+                dropped = 0
+                for submission_id in due:
+                    interval = intervals[submission_id]
+                    if new_counts.get(submission_id):
+                        intervals[submission_id] = max(min_interval, interval / 2)
+                    elif interval >= max_interval and submission_id not in pinned and submission_id not in hot:
+                        del intervals[submission_id]
+                        dropped += 1
+                        continue
+                    else:
+                        intervals[submission_id] = min(max_interval, interval * 2)
+                    heapq.heappush(schedule, (time.monotonic() + intervals[submission_id], submission_id))
+                logger.info(f"Monitor cycle {cycles}: polled {len(due)} submissions, "
+                            f"{sum(new_counts.values())} new comments, unwatched {dropped}, watching {len(intervals)}")
+                cycles += 1
+            wake_up = [schedule[0][0]] if schedule else []
+            if subreddits:
+                wake_up.append(next_discovery)
+            if not wake_up:
+                return
+            time.sleep(max(0.0, min(wake_up) - time.monotonic()))
+
+
+    def discover_submissions(self, subreddits, hot_limit=SUBREDDIT_HOT_LIMIT):
+        submission_ids = []
+        for name in subreddits:
+            try:
+                with metrics.external_call("reddit", "hot", subreddit=name):
+                    submission_ids.extend(submission.id for submission in self.reddit.subreddit(name).hot(limit=hot_limit))
+            except REDDIT_ERRORS as e:
+                logger.error(f'Reddit API error listing r/{name}: {e}')
                 self.email_content.append({
-                    "Cause": "Azure AI Language service for abstract summarization",
-                    "Message": f"Comment language: {primary_language} with condifence score {biggest_confidence_score} not support by Azure AI Language service for abstract summarization for comment: {comment.body}"
+                    "Cause": f"Reddit API Error listing r/{name}",
+                    "Message": f"{e}"
                 })
-                return
-            logger.debug('Language is supported by service, proceeding with the analysis...')
-            analyze_sentiment_result = self.text_analytics_client.analyze_sentiment(documents=[comment.body], show_opinion_mining=True, language=primary_language)
-        
-            #print(f"Analyze sentiment result length: {len(analyze_sentiment_result)}")
-            logger.debug(f"Analyze sentiment result length: {len(analyze_sentiment_result)}")
-            for analysis_document in analyze_sentiment_result:
-                #print(f'Sentiment: {analysis_document.sentiment}, error: {analysis_document.is_error}')
-                logger.debug(f'Sentiment: {analysis_document.sentiment}, error: {analysis_document.is_error}')
-                if  not analysis_document.is_error and (analysis_document.sentiment == "negative" or analysis_document.sentiment == "mixed"):
-                    summary_message = self.summarize_comment(comment.body, primary_language)               
-                    logger.debug(f"summary message: {summary_message}")
-                    #print(f"summary message: {summary_message}")
-
-                    target_to_complaints = self.extract_complaints(analysis_document)
-                    logger.debug(f"Target_to_complaints: {target_to_complaints}")
-
-                    priority = "High" if analysis_document.sentiment == "negative" else "Medium"
-
-                    for target_name, complaints in target_to_complaints.items():
-                        complaint_message =f"{target_name}: " + ", ".join(
-                            [assessment.text for complaint in complaints for assessment in complaint.assessments]
-                        )
-                        logger.debug(f"Complaint message: {complaint_message}")
+        return submission_ids
 
-                        self.jira_client.create_issue(
-                            summary=complaint_message.capitalize(),
-                            description=f"User have made {len(complaints)} complaint(s) about '{target_name}', specifically saying that it's '{complaint_message}.\n Comment: {comment.id}.\n Summary: {summary_message}'",
-                            priority=priority
-                        )
-        except AzureError as e:
-            logger.error(f'Azure Text Analytics error: {e}')
+
+    def process_submissions(self, submission_ids):
+        # One shared analysis pass over the new comments of several submissions. A failing submission
+        # is reported and skipped instead of aborting the others. Returns the new comment count per submission.
+        try:
+            with metrics.TRACER.span("process_submissions", submissions=len(submission_ids)):
+                if self.work_queue is not None:
+                    # Retries that are not due yet are picked up by later cycles
+                    return self._search_reddits_queued(submission_ids, max_wait=0)
+                return self._process_submissions(submission_ids)
+        finally:
+            metrics.flush()
+
+
+    def _process_submissions(self, submission_ids):
+        self.start_run()
+        fetched = {}
+        for submission_id in submission_ids:
+            try:
+                fetched[submission_id] = self.fetch_new_comments(submission_id)
+            except REDDIT_ERRORS as e:
+                logger.error(f'Reddit API error for submission {submission_id}: {e}')
+                self.email_content.append({
+                    "Cause": f"Reddit API Error for submission {submission_id}",
+                    "Message": f"{e}"
+                })
+        comments = [comment for submission_comments in fetched.values() for comment in submission_comments]
+        if comments:
+            documents = self.filter_unticketed(comments)
+            logger.debug(f"Documents length: {len(documents)}")
+            self.analyze_comments(documents)
+            self.flush_tickets()
+            logger.info(f"Pre-filter counts: {self.prefilter.stats()}")
+        for submission_id, submission_comments in fetched.items():
+            self.record_processed(submission_id, submission_comments)
+        return {submission_id: len(submission_comments) for submission_id, submission_comments in fetched.items()}
+
+
+    def _search_reddits_queued(self, submission_ids, max_wait=QUEUE_MAX_WAIT):
+        # Queues the new comments of each submission, then works through the queue. A failing fetch or stage
+        # does not abort the run: fetches are retried by the next run, failed comments by the queue.
+        self.start_run()
+        new_counts = {}
+        for submission_id in submission_ids:
+            try:
+                comments = self.fetch_new_comments(submission_id)
+            except Exception as e:
+                logger.error(f'Error fetching comments of submission {submission_id}: {e}')
+                self.email_content.append({
+                    "Cause": f"Fetching comments of submission {submission_id}",
+                    "Message": f"{e}"
+                })
+                continue
+            queued = self.work_queue.enqueue(submission_id, comments)
+            # Durably queued, so later fetches can skip them
+            self.state.record_seen(submission_id, comments)
+            logger.debug(f"{queued} comments of submission {submission_id} queued")
+            new_counts[submission_id] = len(comments)
+        self.drain_queue(max_wait)
+        return new_counts
+
+
+    def drain_queue(self, max_wait=QUEUE_MAX_WAIT, batch_size=QUEUE_BATCH_SIZE):
+        # Runs the due work items stage by stage until none is left, waiting up to max_wait seconds in total
+        # for retries to come due. Items claimed by a crashed process on this host are resumed first.
+        self.work_queue.recover()
+        waited = 0.0
+        while True:
+            progressed = False
+            for stage in STAGES:
+                while True:
+                    items = self.work_queue.claim(stage, batch_size)
+                    if not items:
+                        break
+                    progressed = True
+                    self.run_queue_stage(stage, items)
+            if progressed:
+                continue
+            delay = self.work_queue.seconds_until_due()
+            if delay is None or waited + delay > max_wait:
+                break
+            time.sleep(delay)
+            waited += delay
+        counts = self.work_queue.counts()
+        logger.info(f"Work queue: {counts}")
+        dead = sum(count for key, count in counts.items() if key.endswith("/dead"))
+        if dead:
+            logger.warning(f"{dead} dead-lettered comments in the work queue; list them with "
+                           f"`python srcdata/work_queue.py dead` and retry with `python srcdata/work_queue.py requeue`")
+        logger.info(f"Pre-filter counts: {self.prefilter.stats()}")
+        for span in self._comment_spans.values():
+            span.end()
+        self._comment_spans = {}
+
+
+    def run_queue_stage(self, stage, items):
+        comments = {item.comment_id: _comment_from_fields(item.comment) for item in items}
+        self.failures = {}
+        try:
+            # comment ID -> ("advance", payload for the next stage) or ("done", outcome)
+            results = getattr(self, f"_queue_{stage}")(items, comments)
+        except Exception as e:
+            logger.error(f'Error in work queue stage {stage}: {e}')
             self.email_content.append({
-                "Cause": "Azure Text Analytics error",
+                "Cause": f"Error in work queue stage {stage}",
                 "Message": f"{e}"
             })
-            return
+            results = {}
+            self.failures = {comment_id: e for comment_id in comments}
+        for item in items:
+            error = self.failures.get(item.comment_id)
+            if error is not None:
+                if self.work_queue.fail(item, error):
+                    metrics.WORK_ITEMS.inc(stage=stage, result="dead_lettered")
+                    self.comment_event([item.comment_id], "dead_lettered", stage=stage)
+                    self.email_content.append({
+                        "Cause": f"Comment {item.comment_id} dead-lettered at stage {stage}",
+                        "Message": f"{error}"
+                    })
+                else:
+                    metrics.WORK_ITEMS.inc(stage=stage, result="retried")
+                continue
+            action, value = results.get(item.comment_id, ("done", "skipped"))
+            if action == "advance":
+                self.work_queue.advance(item, value)
+            else:
+                self.work_queue.complete([item], value)
+            metrics.WORK_ITEMS.inc(stage=stage, result=action)
+
+
+    def _queue_dedupe(self, items, comments):
+        documents = self.filter_unticketed(list(comments.values()))
+        unticketed = {comment.id for comment in documents}
+        kept = {comment.id for comment in self.prefilter_comments(documents)}
+        return {
+            comment_id: ("advance", {}) if comment_id in kept
+            else ("done", "filtered" if comment_id in unticketed else "already_ticketed")
+            for comment_id in comments
+        }
+
+
+    def _queue_analyze(self, items, comments):
+        results = {comment_id: ("done", "filtered") for comment_id in comments}
+        for comment, primary_language, analysis_document in self.analyze_sentiments(self.detect_languages(list(comments.values()))):
+            results[comment.id] = ("advance", {"language": primary_language, "analysis": _analysis_to_dict(analysis_document)})
+        return results
+
+
+    def _queue_summarize(self, items, comments):
+        payloads = {item.comment_id: item.payload for item in items}
+        negative = [
+            (comments[item.comment_id], item.payload["language"], _analysis_from_dict(item.payload["analysis"]))
+            for item in items
+        ]
+        return {
+            comment.id: ("advance", dict(payloads[comment.id], summary=summary_message))
+            for comment, primary_language, analysis_document, summary_message in self.summarize_comments(negative)
+        }
+
+
+    def _queue_ticket(self, items, comments):
+        results = {}
+        try:
+            for item in items:
+                if self.state.is_ticketed(item.comment_id):
+                    # Ticketed by a run that stopped before completing the item; do not post it to Jira again
+                    results[item.comment_id] = ("done", "ticketed")
+                    continue
+                analysis_document = _analysis_from_dict(item.payload["analysis"])
+                self.create_tickets(comments[item.comment_id], analysis_document, item.payload["summary"])
+                results[item.comment_id] = ("done", "ticketed" if self.extract_complaints(analysis_document) else "filtered")
+            self.flush_tickets()
+        except Exception:
+            # The items are retried; complaints left from this attempt would be ticketed with the next batch too
+            with self._complaints_lock:
+                self.pending_complaints = []
+            raise
+        return results
+
+
+    async def _iter_fetch_steps(self, call, submission_id):
+        submission: Submission = await call("reddit", self.reddit.submission, submission_id)
+        seen = set()
+        more = True
+        while more:
+            more, batch = await call("reddit", self._fetch_step, submission, seen)
+            yield batch
+
+
+    def _fetch_step(self, submission, seen):
+        # Expands up to REPLACE_MORE_STEP MoreComments and returns (more_remaining, comments not seen before),
+        # so the first comments reach the next stages while the rest of the tree is still being fetched.
+        with metrics.external_call("reddit", "fetch_step", submission_id=submission.id):
+            remaining = submission.comments.replace_more(limit=REPLACE_MORE_STEP)
+            batch = [comment for comment in submission.comments.list() if comment.id not in seen]
+        seen.update(comment.id for comment in batch)
+        self.track_comments(batch, submission.id)
+        return len(remaining) > 0, batch
+
+
+    def fetch_new_comments(self, submission_id: str):
+        # Comments that are new or edited since the last run. Until a pass over the submission completes
+        # (see StateStore.get_watermark), the whole comment tree is expanded. Later runs take the new comments,
+        # at any depth, from the subreddit's comment listing (newest first) back to the watermark, and check the
+        # comments loaded with the submission for edits. Reddit only lists the last ~1000 comments of a
+        # subreddit, so when the listing does not reach back to the watermark the whole tree is expanded again.
+        watermark = self.state.get_watermark(submission_id)
+        incremental = watermark is not None
+        with metrics.external_call("reddit", "fetch_comments", submission_id=submission_id, incremental=incremental):
+            submission: Submission = self.reddit.submission(submission_id)
+            comments = self.list_comments_since(submission, watermark) if incremental else None
+            if comments is None:
+                submission.comments.replace_more(limit=None)
+                comments = submission.comments.list()
+        seen = self.state.seen_versions(submission_id)
+        new_comments = [
+            comment for comment in comments
+            if seen.get(comment.id) != StateStore.edited_version(comment)
+        ]
+        print(f"{len(comments)} comments, {len(new_comments)} new or edited")
+        logger.debug(f"{len(comments)} comments, {len(new_comments)} new or edited")
+        self.track_comments(new_comments, submission_id)
+        return new_comments
+
+
+    def list_comments_since(self, submission: Submission, watermark: float):
+        # None when the subreddit listing ends before reaching the watermark
+        link_id = f"t3_{submission.id}"
+        new_comments = {}
+        for comment in submission.subreddit.comments(limit=None):
+            if float(comment.created_utc) < watermark - WATERMARK_OVERLAP:
+                break
+            if comment.link_id == link_id:
+                new_comments[comment.id] = comment
+        else:
+            return None
+        submission.comments.replace_more(limit=0)
+        comments = submission.comments.list()
+        loaded_ids = {comment.id for comment in comments}
+        return comments + [comment for comment_id, comment in new_comments.items() if comment_id not in loaded_ids]
+
+
+    def record_processed(self, submission_id: str, comments):
+        processed = [comment for comment in comments if comment.id not in self.failed_comment_ids]
+        self.state.record_seen(submission_id, processed, complete=len(processed) == len(comments))
+        for comment in comments:
+            span = self._comment_spans.pop(comment.id, None)
+            if span is not None:
+                span.end(error="left for the next run" if comment.id in self.failed_comment_ids else None)
+
+
+    def start_run(self):
+        self.failed_comment_ids.clear()
+        self.failures = {}
+        # Spans left open by an aborted run
+        for span in self._comment_spans.values():
+            span.end(error="run aborted")
+        self._comment_spans = {}
+
+
+    def track_comments(self, comments, submission_id):
+        # Every new comment taken up by a run is counted, and traced by a "comment" span under the run span
+        metrics.COMMENTS_PROCESSED.inc(len(comments))
+        if metrics.TRACER.enabled:
+            for comment in comments:
+                self._comment_spans[comment.id] = metrics.TRACER.start_span(
+                    "comment", comment_id=comment.id, submission_id=submission_id
+                )
+
+
+    def comment_event(self, comment_ids, name, **attributes):
+        for comment_id in comment_ids:
+            span = self._comment_spans.get(comment_id)
+            if span is not None:
+                span.add_event(name, **attributes)
+                span.set_attribute("outcome", name)
+
+
+    def mark_filtered(self, comment_ids, reason):
+        comment_ids = list(comment_ids)
+        metrics.COMMENTS_FILTERED.inc(len(comment_ids), reason=reason)
+        self.comment_event(comment_ids, "filtered", reason=reason)
+
+
+    def mark_ticketed(self, comment_ids, action, issue_key):
+        new_ids = [comment_id for comment_id in comment_ids if not self.state.is_ticketed(comment_id)]
+        self.state.mark_ticketed(new_ids)
+        metrics.COMMENTS_TICKETED.inc(len(new_ids), action=action)
+        self.comment_event(comment_ids, "ticketed", action=action, issue_key=issue_key)
+
+
+    def mark_failed(self, comment_ids, stage, error=None):
+        comment_ids = list(comment_ids)
+        self.failed_comment_ids.update(comment_ids)
+        self.failures.update((comment_id, error if error is not None else stage) for comment_id in comment_ids)
+        metrics.COMMENTS_FAILED.inc(len(comment_ids), stage=stage)
+        self.comment_event(comment_ids, "failed", stage=stage)
+
+
+    def filter_unticketed(self, comments):
+        # Comments known locally to be ticketed skip Jira entirely; the rest are checked in bulk.
+        pending = [comment for comment in comments if not self.state.is_ticketed(comment.id)]
+        logger.debug(f"{len(comments) - len(pending)} comments already ticketed in local state")
+        if len(pending) < len(comments):
+            self.mark_filtered([comment.id for comment in comments if self.state.is_ticketed(comment.id)], "already_ticketed")
+        documents = []
+        for start in range(0, len(pending), jira.SEARCH_BATCH_SIZE):
+            batch = pending[start:start + jira.SEARCH_BATCH_SIZE]
+            try:
+                ticketed = self.jira_client.find_ticketed_comments([comment.id for comment in batch])
+            except Exception as e:
+                logger.error(f'Error searching Jira tickets for {len(batch)} comments: {e}')
+                self.mark_failed([comment.id for comment in batch], "jira_search", e)
+                self.email_content.append({
+                    "Cause": f"Searching Jira for comments {', '.join(comment.id for comment in batch)}",
+                    "Message": f"{e}"
+                })
+                continue
+            self.state.mark_ticketed(ticketed)
+            if ticketed:
+                self.mark_filtered(ticketed, "already_ticketed")
+            documents.extend(comment for comment in batch if comment.id not in ticketed)
+        return documents
+
+
+    def analyze_comment(self, comment):
+        self.analyze_comments([comment])
+
+
+    def analyze_comments(self, comments):
+        # Batched pipeline: one language detection call per LANGUAGE_BATCH_SIZE comments, sentiment
+        # per language in SENTIMENT_BATCH_SIZE chunks, and one summarization operation per
+        # SUMMARY_BATCH_SIZE negative comments, instead of three calls per comment.
+        # IDs of the comments still going through the stages, marked failed if one of them raises
+        pending = [comment.id for comment in comments]
+        try:
+            comments = self.prefilter_comments(comments)
+            pending = [comment.id for comment in comments]
+            detected = self.detect_languages(comments)
+            pending = [comment.id for comment, _ in detected]
+            negative = self.analyze_sentiments(detected)
+            pending = [item[0].id for item in negative]
+            summarized = self.summarize_comments(negative)
+            pending = set(item[0].id for item in summarized)
+            for comment, primary_language, analysis_document, summary_message in summarized:
+                self.create_tickets(comment, analysis_document, summary_message)
+                pending.discard(comment.id)
         except Exception as e:
-            logger.error(f'Error occured at analyzing comment: {e}')
+            logger.error(f'Error occured at analyzing comments: {e}')
+            self.mark_failed([comment_id for comment_id in pending if comment_id not in self.failed_comment_ids], "analyze", e)
             self.email_content.append({
-                "Cause": "Error occured at analyzing comment",
+                "Cause": "Error occured at analyzing comments",
                 "Message": f"{e}"
             })
-            return
 
 
-    def summarize_comment(self, comment_body, primary_language):
-        try:
-            logger.debug(f'Analyzing comment body: {comment_body}')
-            abstract_summarization_poller = self.text_analytics_client.begin_abstract_summary(
-                documents=[comment_body],
-                language=primary_language
-            )
-            abstract_summarization_result = abstract_summarization_poller.result()
-            summary_message = ""
-            for item in list(abstract_summarization_result):
+    def prefilter_comments(self, comments):
+        kept = self.prefilter.filter(comments)
+        if self._comment_spans and len(kept) < len(comments):
+            # The pre-filter counts its drops per rule itself
+            kept_ids = {comment.id for comment in kept}
+            self.comment_event([comment.id for comment in comments if comment.id not in kept_ids], "filtered",
+                               reason="prefilter")
+        return kept
+
+
+    def _report_azure_error(self, e, comments):
+        logger.error(f'Azure Text Analytics error: {e}')
+        self.mark_failed([comment.id for comment in comments], "azure", e)
+        self.email_content.append({
+            "Cause": "Azure Text Analytics error",
+            "Message": f"{e} (comments: {', '.join(comment.id for comment in comments)})"
+        })
+
+
+    def detect_languages(self, comments):
+        # Returns (comment, primary_language) for the comments in a language supported by abstract summarization.
+        detected = []
+        for start in range(0, len(comments), LANGUAGE_BATCH_SIZE):
+            batch = comments[start:start + LANGUAGE_BATCH_SIZE]
+            try:
+                with metrics.external_call("azure", "detect_language", documents=len(batch)):
+                    language_detection = self.text_analytics_client.detect_language(documents=[comment.body for comment in batch])
+            except AzureError as e:
+                self._report_azure_error(e, batch)
+                continue
+            for comment, item in zip(batch, language_detection):
+                biggest_confidence_score = 0
+                primary_language = "en"
+                if not item.is_error:
+                    logger.debug(f"Comment {comment.id}: confidence score: {item.primary_language.confidence_score}, language: {item.primary_language.name}")
+                    biggest_confidence_score = item.primary_language.confidence_score
+                    primary_language = item.primary_language.iso6391_name
+                logger.debug(f"Primary language of comment {comment.id} in ISO format: {primary_language} with confidence score: {biggest_confidence_score}")
+                if not primary_language in SUMMARY_LANGUAGES:
+                    logger.error(f"Comment language: {primary_language} not support by Azure AI Language service for abstract summarization")
+                    self.email_content.append({
+                        "Cause": "Azure AI Language service for abstract summarization",
+                        "Message": f"Comment language: {primary_language} with condifence score {biggest_confidence_score} not support by Azure AI Language service for abstract summarization for comment: {comment.body}"
+                    })
+                    self.mark_filtered([comment.id], "unsupported_language")
+                    continue
+                detected.append((comment, primary_language))
+        return detected
+
+
+    def analyze_sentiments(self, detected):
+        # Returns (comment, primary_language, analysis_document) for the negative and mixed comments.
+        negative = []
+        for primary_language, group in self._group_by_language(detected).items():
+            for start in range(0, len(group), SENTIMENT_BATCH_SIZE):
+                batch = group[start:start + SENTIMENT_BATCH_SIZE]
+                try:
+                    with metrics.external_call("azure", "analyze_sentiment", documents=len(batch), language=primary_language):
+                        analyze_sentiment_result = self.text_analytics_client.analyze_sentiment(
+                            documents=[comment.body for comment in batch], show_opinion_mining=True, language=primary_language
+                        )
+                except AzureError as e:
+                    self._report_azure_error(e, batch)
+                    continue
+                for comment, analysis_document in zip(batch, analyze_sentiment_result):
+                    logger.debug(f'Comment {comment.id}: sentiment: {getattr(analysis_document, "sentiment", None)}, error: {analysis_document.is_error}')
+                    if not analysis_document.is_error and (analysis_document.sentiment == "negative" or analysis_document.sentiment == "mixed"):
+                        negative.append((comment, primary_language, analysis_document))
+                    else:
+                        self.mark_filtered([comment.id], "sentiment_error" if analysis_document.is_error else "not_negative")
+        return negative
+
+
+    def summarize_comments(self, negative):
+        # Submits one abstract summarization operation per batch, all of them before waiting on any, and
+        # returns (comment, primary_language, analysis_document, summary_message) in the input order.
+        summaries = {}
+        operations = []
+        grouped = self._group_by_language([(item[0], item[1]) for item in negative])
+        for primary_language, group in grouped.items():
+            for start in range(0, len(group), SUMMARY_BATCH_SIZE):
+                batch = group[start:start + SUMMARY_BATCH_SIZE]
+                try:
+                    with metrics.external_call("azure", "begin_abstract_summary", documents=len(batch), language=primary_language):
+                        poller = self.text_analytics_client.begin_abstract_summary(
+                            documents=[comment.body for comment in batch],
+                            language=primary_language
+                        )
+                    operations.append((batch, poller))
+                except AzureError as e:
+                    self._report_azure_error(e, batch)
+        for batch, poller in operations:
+            try:
+                with metrics.external_call("azure", "abstract_summary_result", documents=len(batch)):
+                    abstract_summarization_result = list(poller.result())
+            except AzureError as e:
+                self._report_azure_error(e, batch)
+                continue
+            for comment, item in zip(batch, abstract_summarization_result):
+                summary_message = ""
                 if not item.is_error and len(item.summaries) > 0:
                     for summary in item.summaries:
                         summary_message = summary_message + summary.text + ". "
-            return summary_message
-        except AzureError as e:
-            logger.error(f'Azure Text Analytics error: {e}')
+                summaries[comment.id] = summary_message
+        # A failed summarization does not block the ticket, as before it just leaves the summary empty.
+        return [(comment, primary_language, analysis_document, summaries.get(comment.id, ""))
+                for comment, primary_language, analysis_document in negative]
+
+
+    @staticmethod
+    def _group_by_language(detected):
+        groups: Dict[str, Any] = {}
+        for comment, primary_language in detected:
+            groups.setdefault(primary_language, []).append(comment)
+        return groups
+
+
+    def create_tickets(self, comment, analysis_document, summary_message):
+        logger.debug(f"summary message: {summary_message}")
+        target_to_complaints = self.extract_complaints(analysis_document)
+        # repr of the Azure opinion objects is costly, only build it when DEBUG output is enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Target_to_complaints: {target_to_complaints}")
+        if not target_to_complaints:
+            self.mark_filtered([comment.id], "no_complaint")
+
+        priority = "High" if analysis_document.sentiment == "negative" else "Medium"
+
+        for target_name, complaints in target_to_complaints.items():
+            complaint_message =f"{target_name}: " + ", ".join(
+                [assessment.text for complaint in complaints for assessment in complaint.assessments]
+            )
+            logger.debug(f"Complaint message: {complaint_message}")
+
+            complaint = Complaint(
+                comment_id=comment.id,
+                summary=complaint_message.capitalize(),
+                description=f"User have made {len(complaints)} complaint(s) about '{target_name}', specifically saying that it's '{complaint_message}.\n Comment: {comment.id}.\n Summary: {summary_message}'",
+                priority=priority,
+                text=f"{complaint_message}. {summary_message}"
+            )
+            with self._complaints_lock:
+                self.pending_complaints.append(complaint)
+
+
+    def flush_tickets(self):
+        # Groups the complaints of the run into clusters of near duplicates: a cluster matching an existing
+        # issue gets a Jira comment referencing its Reddit comments, any other cluster becomes one new ticket.
+        with self._complaints_lock:
+            complaints, self.pending_complaints = self.pending_complaints, []
+        if complaints:
+            try:
+                self.clusterer.sync_issues(self.jira_client)
+            except Exception as e:
+                logger.error(f'Error syncing the complaint index with Jira: {e}')
+                self.email_content.append({
+                    "Cause": "Syncing the complaint index with Jira",
+                    "Message": f"{e}"
+                })
+            for cluster in self.clusterer.cluster(complaints):
+                if cluster.existing_issue is not None:
+                    self.attach_to_issue(cluster)
+                    continue
+                others = [comment_id for comment_id in cluster.comment_ids if comment_id != cluster.leader.comment_id]
+                description = cluster.leader.description
+                if others:
+                    description += f"\n {len(others)} similar complaint(s) in comments: {', '.join(others)}."
+                priority = "High" if any(member.priority == "High" for member in cluster.members) else cluster.leader.priority
+                self.handle_issue_results(self.jira_client.queue_issue(
+                    summary=cluster.leader.summary,
+                    description=description,
+                    priority=priority,
+                    source=cluster
+                ))
+        self.handle_issue_results(self.jira_client.flush())
+
+
+    def attach_to_issue(self, cluster):
+        comment_ids = cluster.comment_ids
+        body = "\n".join(
+            [f"{len(comment_ids)} more user complaint(s) matching this issue, from comments: {', '.join(comment_ids)}."] +
+            [f"- {member.summary}" for member in cluster.members]
+        )
+        try:
+            self.jira_client.add_comment(cluster.existing_issue, body)
+            self.mark_ticketed(comment_ids, "commented", cluster.existing_issue)
+        except Exception as e:
+            self.mark_failed(comment_ids, "jira_comment", e)
+            logger.error(f'Error attaching comments {comment_ids} to Jira issue {cluster.existing_issue}: {e}')
             self.email_content.append({
-                "Cause": "Azure Text Analytics error",
+                "Cause": f"Attaching comments {', '.join(comment_ids)} to Jira issue {cluster.existing_issue}",
                 "Message": f"{e}"
             })
-            return ""
+
+
+    def handle_issue_results(self, results):
+        # Results of a bulk ticket creation, see JiraClient.queue_issue; `source` is the ComplaintCluster.
+        for result in results:
+            comment_ids = result.source.comment_ids
+            if result.key:
+                self.mark_ticketed(comment_ids, "created", result.key)
+                self.clusterer.add_issue(result.key, result.source.leader.summary, result.source.vector)
+                continue
+            self.mark_failed(comment_ids, "jira_create", result.error)
+            logger.error(f'Error creating Jira ticket for comments {comment_ids}: {result.error}')
+            self.email_content.append({
+                "Cause": f"Creating Jira ticket for comments {', '.join(comment_ids)}",
+                "Message": f"{result.error}"
+            })
 
 
     def extract_complaints(self, analysis_document):
@@ -202,11 +977,11 @@ class RedditAnalyzer:
                     },
                     "content": {
                         "subject": "Errors found after last pipeline run",
-                        "plainText": f"The following issues were raised during the last pipeline execution:\n\n {json.dumps(obj=self.email_content, indent=4)}",
+                        "plainText": f"The following issues were raised during the last pipeline execution:\n\n {json.dumps(obj=list(self.email_content), indent=4)}",
                     }
                 }
                 client.begin_send(message)
-                self.email_content = []
+                self.email_content.clear()
         except Exception as e:
             logger.error(f"Error at sending notification email: {e}")
 
@@ -237,7 +1012,45 @@ if __name__ == "__main__":
     reporter_id = environment_variables.get('JIRA_REPORTER_ID')
     issue_type = environment_variables.get('JIRA_ISSUE_TYPE')
 
+    # Local state (comments already ticketed, ...) shared between runs
+    state_path = environment_variables.get('REDDIT_STATE_PATH', DEFAULT_STATE_PATH)
+
+    # "async" runs the stages concurrently (search_reddits_async), anything else sequentially
+    pipeline_mode = environment_variables.get('REDDIT_PIPELINE_MODE', 'sequential')
+
+    # Monitor mode: comma separated submission IDs and/or subreddit names to watch continuously
+    monitored_submissions = [item for item in environment_variables.get('REDDIT_SUBMISSION_IDS', '').split(',') if item]
+    monitored_subreddits = [item for item in environment_variables.get('REDDIT_SUBREDDITS', '').split(',') if item]
+
+    # Optional local classifier (e.g. train_pipeline_bertVersion.py --task classification) run before Azure
+    prefilter = CommentPreFilter(classifier_path=environment_variables.get('PREFILTER_CLASSIFIER_PATH'))
+
+    # Metrics exports: Prometheus text file rewritten after every run and/or HTTP endpoint; spans as JSON lines
+    metrics.configure(
+        metrics_file=environment_variables.get('METRICS_FILE'),
+        metrics_port=int(environment_variables.get('METRICS_PORT', 0)) or None,
+        trace_file=environment_variables.get('TRACE_FILE'),
+    )
+
+    # Persistent embedding index of Jira issues used to merge duplicate complaints
+    clusterer = ComplaintClusterer(ComplaintIndex(environment_variables.get('COMPLAINT_INDEX_PATH', DEFAULT_INDEX_PATH)))
+
+    # Durable work queue: comments go through the pipeline stage by stage, a restarted run resumes where it stopped.
+    # Dead-lettered comments are listed and retried with `python srcdata/work_queue.py dead|requeue`.
+    # The async pipeline keeps its own in-memory stages and does not use it.
+    work_queue = None
+    if pipeline_mode == 'async' and not (monitored_submissions or monitored_subreddits):
+        if 'REDDIT_QUEUE_PATH' in environment_variables:
+            logger.warning('REDDIT_QUEUE_PATH is ignored with REDDIT_PIPELINE_MODE=async')
+    else:
+        work_queue = WorkQueue(environment_variables.get('REDDIT_QUEUE_PATH', DEFAULT_QUEUE_PATH))
+
     analyzer = RedditAnalyzer(client_id, client_secret, password, user_agent, username, endpoint, key, jira_email, jira_token, 
-                              base_url, project_id, reporter_id, issue_type)
-    analyzer.search_reddits(submission_id)
+                              base_url, project_id, reporter_id, issue_type, state_path, prefilter, clusterer, work_queue)
+    if monitored_submissions or monitored_subreddits:
+        analyzer.monitor(monitored_submissions, monitored_subreddits)
+    elif pipeline_mode == 'async':
+        asyncio.run(analyzer.search_reddits_async(submission_id))
+    else:
+        analyzer.search_reddits(submission_id)
 
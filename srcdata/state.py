@@ -0,0 +1,96 @@
+import sqlite3, threading, time, logging, os, sys
+from typing import Dict, Iterable, Optional, Set
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(formatter)
+logger = logging.getLogger('StateStore')
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+DEFAULT_STATE_PATH = "reddit_state.db"
+
+
+# Local SQLite store of what previous runs already did, so later runs can skip Jira and Azure.
+class StateStore:
+    def __init__(self, path: str = DEFAULT_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ticketed_comments (comment_id TEXT PRIMARY KEY, ticketed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_comments (submission_id TEXT NOT NULL, comment_id TEXT NOT NULL, "
+            "created_utc REAL NOT NULL, edited REAL NOT NULL, PRIMARY KEY (submission_id, comment_id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS submissions (submission_id TEXT PRIMARY KEY, watermark_utc REAL NOT NULL, "
+            "last_run REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._ticketed: Set[str] = {row[0] for row in self._conn.execute("SELECT comment_id FROM ticketed_comments")}
+        logger.debug(f'Loaded {len(self._ticketed)} ticketed comment IDs from {path}')
+
+    def is_ticketed(self, comment_id: str) -> bool:
+        return comment_id in self._ticketed
+
+    def mark_ticketed(self, comment_ids: Iterable[str]):
+        new_ids = [comment_id for comment_id in comment_ids if comment_id not in self._ticketed]
+        if not new_ids:
+            return
+        with self._lock:
+            now = time.time()
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO ticketed_comments (comment_id, ticketed_at) VALUES (?, ?)",
+                [(comment_id, now) for comment_id in new_ids]
+            )
+            self._conn.commit()
+            self._ticketed.update(new_ids)
+
+    @staticmethod
+    def edited_version(comment) -> float:
+        # PRAW exposes `edited` as False or the timestamp of the last edit
+        return float(getattr(comment, "edited", False) or 0)
+
+    def get_watermark(self, submission_id: str) -> Optional[float]:
+        # created_utc of the newest comment of the last complete pass over the submission (one where no
+        # comment failed), None if there never was one
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT watermark_utc FROM submissions WHERE submission_id = ?", (submission_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def seen_versions(self, submission_id: str) -> Dict[str, float]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT comment_id, edited FROM seen_comments WHERE submission_id = ?", (submission_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def record_seen(self, submission_id: str, comments, complete: bool = True):
+        # complete=False when some comments of the pass failed and are left out: the watermark is not moved,
+        # so the next run still fetches deep enough to find them again
+        comments = list(comments)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO seen_comments (submission_id, comment_id, created_utc, edited) VALUES (?, ?, ?, ?)",
+                [(submission_id, comment.id, float(comment.created_utc), self.edited_version(comment)) for comment in comments]
+            )
+            if not complete:
+                self._conn.commit()
+                return
+            watermark = max([float(comment.created_utc) for comment in comments], default=0.0)
+            self._conn.execute(
+                "INSERT INTO submissions (submission_id, watermark_utc, last_run) VALUES (?, ?, ?) "
+                "ON CONFLICT(submission_id) DO UPDATE SET watermark_utc = MAX(watermark_utc, excluded.watermark_utc), "
+                "last_run = excluded.last_run",
+                (submission_id, watermark, time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
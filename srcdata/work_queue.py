@@ -0,0 +1,297 @@
+import argparse, json, logging, os, random, socket, sqlite3, sys, threading, time
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+from requests.exceptions import JSONDecodeError as ResponseJSONDecodeError
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', "%d-%m-%Y %H:%M:%S")
+handler = logging.StreamHandler(stream=sys.stdout)
+handler.setFormatter(formatter)
+logger = logging.getLogger('WorkQueue')
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'DEBUG'))
+
+DEFAULT_QUEUE_PATH = "reddit_queue.db"
+# Stages a comment goes through, in order: Jira dedupe + pre-filter, language + sentiment, summarization, ticketing
+STAGES = ("dedupe", "analyze", "summarize", "ticket")
+PENDING, CLAIMED, DONE, DEAD = "pending", "claimed", "done", "dead"
+# Seconds a claimed item stays reserved to its worker; afterwards another worker may take it over
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+# Errors in our own code or data: retrying cannot help
+PERMANENT_EXCEPTIONS = (AttributeError, KeyError, TypeError, ValueError)
+# ValueErrors all the same, but raised by an HTML error page or a truncated body from Jira or a gateway
+DECODE_EXCEPTIONS = (json.JSONDecodeError, ResponseJSONDecodeError)
+
+# A claimed comment: `comment` holds its PRAW fields (id, body, author, created_utc, edited), `payload` the
+# results of the previous stages, `version` its edit timestamp (an edited comment is a new version)
+WorkItem = namedtuple('WorkItem', ['comment_id', 'submission_id', 'stage', 'attempts', 'version', 'comment', 'payload'])
+
+
+def is_transient(error) -> bool:
+    # HTTP errors (requests, Azure) are transient for timeouts, throttling and 5xx only; connection errors
+    # and errors only known by their message (e.g. Jira bulk results) are retried until MAX_ATTEMPTS
+    if isinstance(error, DECODE_EXCEPTIONS):
+        return True
+    if isinstance(error, PERMANENT_EXCEPTIONS):
+        return False
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    return True
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Durable per-comment work queue in SQLite. Workers claim the due items of a stage under a lease, then
+# advance them to the next stage (with the stage results as payload), complete them, or record a failure:
+# transient failures are retried with exponential backoff, permanent ones (and items out of attempts) are
+# dead-lettered. Everything is committed as it happens, so a restarted process resumes where it stopped.
+class WorkQueue:
+    def __init__(self, path: str = DEFAULT_QUEUE_PATH, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        # Autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE where reads and writes must be atomic
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS work_items (comment_id TEXT PRIMARY KEY, submission_id TEXT NOT NULL, "
+            "version REAL NOT NULL, stage TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt_at REAL NOT NULL DEFAULT 0, lease_owner TEXT, lease_expires_at REAL, "
+            "comment TEXT NOT NULL, payload TEXT NOT NULL DEFAULT '{}', outcome TEXT, last_error TEXT, "
+            "updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS work_items_due ON work_items (stage, status, next_attempt_at)")
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent workers never claim the same items
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _backoff(self, attempts: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempts)))
+
+    def enqueue(self, submission_id: str, comments) -> int:
+        # Adds new comments at the first stage. An edited comment (higher version) starts over, even if it
+        # was done or dead-lettered; an unchanged one is left alone. Returns the number of items (re)queued.
+        now = time.time()
+        rows = [
+            (comment.id, submission_id, float(getattr(comment, "edited", False) or 0), STAGES[0], PENDING,
+             json.dumps(self.comment_fields(comment)), now)
+            for comment in comments
+        ]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT INTO work_items (comment_id, submission_id, version, stage, status, comment, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(comment_id) DO UPDATE SET version = excluded.version, stage = excluded.stage, "
+                "status = excluded.status, attempts = 0, next_attempt_at = 0, lease_owner = NULL, "
+                "lease_expires_at = NULL, comment = excluded.comment, payload = '{}', outcome = NULL, "
+                "last_error = NULL, updated_at = excluded.updated_at "
+                "WHERE excluded.version > work_items.version",
+                rows
+            )
+            return conn.total_changes - before
+
+    @staticmethod
+    def comment_fields(comment) -> Dict:
+        author = getattr(comment, "author", None)
+        return {
+            "id": comment.id,
+            "body": comment.body,
+            "author": getattr(author, "name", None),
+            "created_utc": float(comment.created_utc),
+            "edited": float(getattr(comment, "edited", False) or 0),
+        }
+
+    def claim(self, stage: str, limit: int) -> List[WorkItem]:
+        # Due pending items of the stage, plus claimed ones whose lease expired (their worker died)
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT comment_id, submission_id, stage, attempts, version, comment, payload FROM work_items "
+                "WHERE stage = ? AND ((status = ? AND next_attempt_at <= ?) OR (status = ? AND lease_expires_at <= ?)) "
+                "ORDER BY next_attempt_at, updated_at LIMIT ?",
+                (stage, PENDING, now, CLAIMED, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE work_items SET status = ?, lease_owner = ?, lease_expires_at = ?, updated_at = ? "
+                "WHERE comment_id = ?",
+                [(CLAIMED, self.owner, now + self.lease_seconds, now, row[0]) for row in rows]
+            )
+        return [
+            WorkItem(comment_id, submission_id, stage, attempts, version, json.loads(comment), json.loads(payload))
+            for comment_id, submission_id, stage, attempts, version, comment, payload in rows
+        ]
+
+    def _update_claimed(self, items: Iterable[WorkItem], assignments: str, values_for) -> int:
+        # Only touches items still claimed by this worker at the claimed version: an item whose lease was
+        # taken over, or which was edited and requeued in the meantime, is left to its new state
+        items = list(items)
+        if not items:
+            return 0
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                f"UPDATE work_items SET {assignments}, lease_owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                "WHERE comment_id = ? AND status = ? AND lease_owner = ? AND version = ?",
+                [(*values_for(item), now, item.comment_id, CLAIMED, self.owner, item.version) for item in items]
+            )
+            return conn.total_changes - before
+
+    def advance(self, item: WorkItem, payload: Dict):
+        # Moves the item to the next stage, due immediately, with a fresh attempt count
+        next_stage = STAGES[STAGES.index(item.stage) + 1]
+        self._update_claimed(
+            [item], "stage = ?, status = ?, attempts = 0, next_attempt_at = 0, payload = ?, last_error = NULL",
+            lambda _: (next_stage, PENDING, json.dumps(payload))
+        )
+
+    def complete(self, items: Iterable[WorkItem], outcome: str):
+        self._update_claimed(items, "status = ?, outcome = ?", lambda _: (DONE, outcome))
+
+    def fail(self, item: WorkItem, error) -> bool:
+        # Records a failed attempt; returns True when the item was dead-lettered instead of scheduled for a retry
+        attempts = item.attempts + 1
+        if not is_transient(error) or attempts >= self.max_attempts:
+            self._update_claimed(
+                [item], "status = ?, attempts = ?, last_error = ?", lambda _: (DEAD, attempts, f"{error}")
+            )
+            logger.error(f'Comment {item.comment_id} dead-lettered at stage {item.stage} after {attempts} attempt(s): {error}')
+            return True
+        delay = self._backoff(attempts)
+        self._update_claimed(
+            [item], "status = ?, attempts = ?, next_attempt_at = ?, last_error = ?",
+            lambda _: (PENDING, attempts, time.time() + delay, f"{error}")
+        )
+        logger.warning(f'Comment {item.comment_id} failed at stage {item.stage} (attempt {attempts}), retrying in {delay:.1f}s: {error}')
+        return False
+
+    def recover(self) -> int:
+        # Releases the items claimed by processes of this host that no longer run (e.g. after a crash),
+        # so a restarted process resumes them right away instead of waiting for their leases to expire
+        host = socket.gethostname()
+        with self._lock:
+            owners = [row[0] for row in self._conn.execute(
+                "SELECT DISTINCT lease_owner FROM work_items WHERE status = ?", (CLAIMED,)
+            )]
+        dead_owners = []
+        for owner in owners:
+            owner_host, _, pid = (owner or "").rpartition(":")
+            if owner != self.owner and owner_host == host and pid.isdigit() and not _process_alive(int(pid)):
+                dead_owners.append(owner)
+        if not dead_owners:
+            return 0
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "UPDATE work_items SET status = ?, lease_owner = NULL, lease_expires_at = NULL WHERE status = ? AND lease_owner = ?",
+                [(PENDING, CLAIMED, owner) for owner in dead_owners]
+            )
+            released = conn.total_changes - before
+        logger.info(f'Released {released} work items claimed by stopped processes {dead_owners}')
+        return released
+
+    def seconds_until_due(self) -> Optional[float]:
+        # Delay until the next pending (or lease-expired) item becomes due, None when there is nothing left to do
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(CASE WHEN status = ? THEN next_attempt_at ELSE lease_expires_at END) FROM work_items "
+                "WHERE status IN (?, ?)", (PENDING, PENDING, CLAIMED)
+            ).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def counts(self) -> Dict[str, int]:
+        # Items per "stage/status", e.g. {"analyze/pending": 12, "ticket/done": 40}
+        with self._lock:
+            rows = self._conn.execute("SELECT stage, status, COUNT(*) FROM work_items GROUP BY stage, status").fetchall()
+        return {f"{stage}/{status}": count for stage, status, count in rows}
+
+    def dead_letters(self, limit: int = 100) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT comment_id, submission_id, stage, attempts, last_error, updated_at FROM work_items "
+                "WHERE status = ? ORDER BY updated_at DESC LIMIT ?", (DEAD, limit)
+            ).fetchall()
+        return [dict(zip(("comment_id", "submission_id", "stage", "attempts", "last_error", "updated_at"), row)) for row in rows]
+
+    def requeue_dead(self, comment_ids: Optional[Iterable[str]] = None) -> int:
+        # Gives dead-lettered items (all of them by default) a fresh set of attempts at the stage they failed in
+        with self._transaction() as conn:
+            before = conn.total_changes
+            if comment_ids is None:
+                conn.execute(
+                    "UPDATE work_items SET status = ?, attempts = 0, next_attempt_at = 0 WHERE status = ?", (PENDING, DEAD)
+                )
+            else:
+                conn.executemany(
+                    "UPDATE work_items SET status = ?, attempts = 0, next_attempt_at = 0 WHERE status = ? AND comment_id = ?",
+                    [(PENDING, DEAD, comment_id) for comment_id in comment_ids]
+                )
+            return conn.total_changes - before
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspect the Reddit work queue and retry dead-lettered comments")
+    parser.add_argument("--queue_path", type=str, default=os.environ.get('REDDIT_QUEUE_PATH', DEFAULT_QUEUE_PATH))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("counts", help="Items per stage and status")
+    dead = subparsers.add_parser("dead", help="List the most recent dead-lettered comments")
+    dead.add_argument("--limit", type=int, default=100)
+    requeue = subparsers.add_parser("requeue", help="Retry dead-lettered comments (all of them by default)")
+    requeue.add_argument("comment_ids", nargs="*")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    queue = WorkQueue(args.queue_path)
+    try:
+        if args.command == "counts":
+            print(json.dumps(queue.counts(), indent=4, sort_keys=True))
+        elif args.command == "dead":
+            for item in queue.dead_letters(args.limit):
+                print(json.dumps(item))
+        else:
+            count = queue.requeue_dead(args.comment_ids or None)
+            print(f"Requeued {count} dead-lettered comments; the next run picks them up")
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,87 +1,196 @@
-import os
-import argparse
-import torch
-from datasets import load_dataset, load_metric
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    AutoModelForSequenceClassification,
-    TrainingArguments,
-    Trainer,
-    DataCollatorForSeq2Seq,
-    DataCollatorWithPadding,
-)
-
-def load_and_prepare_data(task, dataset_path):
-    raw_dataset = load_dataset('json', data_files=dataset_path, split='train')
-
-    if task == "summarization":
-        def preprocess(example):
-            return {
-                "input_ids": tokenizer(
-                    example["input"], truncation=True, padding="max_length", max_length=512
-                )["input_ids"],
-                "labels": tokenizer(
-                    example["target"], truncation=True, padding="max_length", max_length=128
-                )["input_ids"],
-            }
-    elif task == "classification":
-        label2id = {label: i for i, label in enumerate(set(raw_dataset["label"]))}
-        def preprocess(example):
-            return {
-                "input_ids": tokenizer(
-                    example["input"], truncation=True, padding="max_length", max_length=512
-                )["input_ids"],
-                "label": label2id[example["label"]],
-            }
-    else:
-        raise ValueError("Unsupported task.")
-
-    dataset = raw_dataset.map(preprocess, remove_columns=raw_dataset.column_names)
-    return dataset
-
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--task", choices=["summarization", "classification"], required=True)
-    parser.add_argument("--dataset_path", type=str, required=True)
-    parser.add_argument("--model_name", type=str, default="meta-llama/Llama-3.1-8B-Instruct")
-    parser.add_argument("--output_dir", type=str, default="./output")
-    args = parser.parse_args()
-
-    global tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True)
-
-    if args.task == "summarization":
-        model = AutoModelForCausalLM.from_pretrained(args.model_name, torch_dtype=torch.float16)
-        data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model=model)
-    else:
-        model = AutoModelForSequenceClassification.from_pretrained(args.model_name, num_labels=2)
-        data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
-
-    dataset = load_and_prepare_data(args.task, args.dataset_path)
-
-    training_args = TrainingArguments(
-        output_dir=args.output_dir,
-        per_device_train_batch_size=2,
-        gradient_accumulation_steps=4,
-        evaluation_strategy="no",
-        num_train_epochs=3,
-        logging_steps=10,
-        save_steps=100,
-        save_total_limit=2,
-        fp16=True,
-        report_to="none",
-    )
-
-    trainer = Trainer(
-        model=model,
-        args=training_args,
-        train_dataset=dataset,
-        tokenizer=tokenizer,
-        data_collator=data_collator,
-    )
-
-    trainer.train()
-
-if __name__ == "__main__":
-    main()
+import os
+import argparse
+import torch
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    AutoModelForSequenceClassification,
+    TrainingArguments,
+    Trainer,
+    DataCollatorForSeq2Seq,
+    DataCollatorWithPadding,
+)
+
+from preprocess_pipeline import (
+    MAP_BATCH_SIZE,
+    TOKENIZED_CACHE_DIR,
+    artifact_path,
+    function_fingerprint,
+    load_or_build,
+    load_raw,
+    tokenize,
+)
+
+IGNORE_INDEX = -100
+PACK_LENGTH = 512
+
+def build_dataset(task, raw_dataset, max_input_length=512, max_target_length=128, num_proc=None, pack_length=None):
+    # Examples are stored unpadded, with their token count in "length" for group_by_length;
+    # padding happens per batch in the data collator
+    if task == "summarization":
+        # Causal LM: the model reads prompt + target, and only the target tokens are scored
+        def preprocess(examples):
+            prompts = tokenizer(examples["input"], truncation=True, max_length=max_input_length)["input_ids"]
+            targets = tokenizer(examples["target"], truncation=True, max_length=max_target_length - 1,
+                                add_special_tokens=False)["input_ids"]
+            input_ids, labels = [], []
+            for prompt, target in zip(prompts, targets):
+                target = target + [tokenizer.eos_token_id]
+                input_ids.append(prompt + target)
+                labels.append([IGNORE_INDEX] * len(prompt) + target)
+            return {"input_ids": input_ids, "labels": labels, "length": [len(ids) for ids in input_ids]}
+    elif task == "classification":
+        # Sorted, so that label ids are the same on every run
+        label2id = {label: i for i, label in enumerate(sorted(set(raw_dataset["label"])))}
+        def preprocess(examples):
+            encoded = tokenizer(examples["input"], truncation=True, max_length=max_input_length)
+            return {
+                "input_ids": encoded["input_ids"],
+                "attention_mask": encoded["attention_mask"],
+                "label": [label2id[label] for label in examples["label"]],
+                "length": [len(ids) for ids in encoded["input_ids"]],
+            }
+    else:
+        raise ValueError("Unsupported task.")
+
+    dataset = tokenize(raw_dataset, preprocess, num_proc=num_proc)
+    if pack_length:
+        dataset = dataset.map(
+            pack_examples,
+            batched=True,
+            batch_size=MAP_BATCH_SIZE,
+            fn_kwargs={"pack_length": pack_length},
+            remove_columns=dataset.column_names,
+            desc="Packing",
+        )
+    return dataset
+
+def pack_examples(examples, pack_length=PACK_LENGTH):
+    # First-fit decreasing: places each example, longest first, in the first row with room left, so rows
+    # end up close to pack_length tokens. position_ids restart at 0 for every example in a row.
+    rows = []
+    order = sorted(range(len(examples["input_ids"])), key=lambda i: len(examples["input_ids"][i]), reverse=True)
+    for i in order:
+        input_ids, labels = examples["input_ids"][i], examples["labels"][i]
+        row = next((row for row in rows if len(row["input_ids"]) + len(input_ids) <= pack_length), None)
+        if row is None:
+            # Examples longer than pack_length get a row of their own
+            row = {"input_ids": [], "labels": [], "position_ids": []}
+            rows.append(row)
+        row["input_ids"].extend(input_ids)
+        row["labels"].extend(labels)
+        row["position_ids"].extend(range(len(input_ids)))
+    return {
+        "input_ids": [row["input_ids"] for row in rows],
+        "labels": [row["labels"] for row in rows],
+        "position_ids": [row["position_ids"] for row in rows],
+        "length": [len(row["input_ids"]) for row in rows],
+    }
+
+class DataCollatorForPacking:
+    """Concatenates the packed rows of a batch into one unpadded sequence.
+
+    There is no attention mask: flash_attention_2 starts a new sequence wherever position_ids restart, so
+    tokens only attend within their own example. The first token of every example belongs to its prompt
+    and is labelled IGNORE_INDEX, so no loss is computed across example boundaries either.
+    """
+    def __call__(self, features):
+        input_ids, labels, position_ids = [], [], []
+        for feature in features:
+            input_ids.extend(feature["input_ids"])
+            labels.extend(feature["labels"])
+            position_ids.extend(feature["position_ids"])
+        return {
+            "input_ids": torch.tensor([input_ids], dtype=torch.long),
+            "labels": torch.tensor([labels], dtype=torch.long),
+            "position_ids": torch.tensor([position_ids], dtype=torch.long),
+        }
+
+def load_and_prepare_data(task, dataset_path, max_input_length=512, max_target_length=128,
+                          cache_dir=TOKENIZED_CACHE_DIR, num_proc=None, rebuild=False, pack_length=None):
+    # Tokenized once per source file, tokenizer, task, max lengths and packing, then memory-mapped from cache_dir
+    path = artifact_path(dataset_path, tokenizer, task, max_input_length, max_target_length,
+                         preprocess=build_dataset, cache_dir=cache_dir, pipeline="llama3", pack_length=pack_length,
+                         pack=function_fingerprint(pack_examples) if pack_length else None)
+    return load_or_build(
+        path,
+        lambda: build_dataset(task, load_raw(dataset_path), max_input_length, max_target_length, num_proc, pack_length),
+        rebuild=rebuild,
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", choices=["summarization", "classification"], required=True)
+    parser.add_argument("--dataset_path", type=str, required=True)
+    parser.add_argument("--model_name", type=str, default="meta-llama/Llama-3.1-8B-Instruct")
+    parser.add_argument("--output_dir", type=str, default="./output")
+    parser.add_argument("--max_input_length", type=int, default=512)
+    parser.add_argument("--max_target_length", type=int, default=128)
+    parser.add_argument("--cache_dir", type=str, default=TOKENIZED_CACHE_DIR, help="Where tokenized datasets are stored")
+    parser.add_argument("--num_proc", type=int, default=None, help="Tokenization processes (default: one per CPU, scaled to the dataset size)")
+    parser.add_argument("--rebuild_cache", action="store_true", help="Tokenize again even if a cached dataset exists")
+    parser.add_argument("--preprocess_only", action="store_true", help="Only build the tokenized dataset, then exit")
+    parser.add_argument("--per_device_train_batch_size", type=int, default=2)
+    parser.add_argument("--packing", action="store_true",
+                        help="Summarization only: pack several examples into each sequence (requires flash-attn)")
+    parser.add_argument("--pack_length", type=int, default=PACK_LENGTH, help="Tokens per packed sequence")
+    args = parser.parse_args()
+    if args.packing and args.task != "summarization":
+        parser.error("--packing is only supported with --task summarization")
+
+    global tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True)
+    # Llama 3 has no padding token; padded positions are masked out (and labelled IGNORE_INDEX) anyway
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    # Tokenize before loading the model, so --preprocess_only never needs the weights
+    dataset = load_and_prepare_data(args.task, args.dataset_path, args.max_input_length, args.max_target_length,
+                                    args.cache_dir, args.num_proc, args.rebuild_cache,
+                                    args.pack_length if args.packing else None)
+    if args.preprocess_only:
+        return
+
+    if args.task == "summarization" and args.packing:
+        model = AutoModelForCausalLM.from_pretrained(args.model_name, torch_dtype=torch.float16,
+                                                     attn_implementation="flash_attention_2")
+        data_collator = DataCollatorForPacking()
+    elif args.task == "summarization":
+        model = AutoModelForCausalLM.from_pretrained(args.model_name, torch_dtype=torch.float16)
+        # Pads input_ids with the pad token and labels with IGNORE_INDEX, up to the longest example of the batch
+        data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model=model, label_pad_token_id=IGNORE_INDEX,
+                                               pad_to_multiple_of=8)
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(args.model_name, num_labels=2)
+        model.config.pad_token_id = tokenizer.pad_token_id
+        data_collator = DataCollatorWithPadding(tokenizer=tokenizer, pad_to_multiple_of=8)
+
+    training_args = TrainingArguments(
+        output_dir=args.output_dir,
+        per_device_train_batch_size=args.per_device_train_batch_size,
+        gradient_accumulation_steps=4,
+        # Batches examples of similar length together, so dynamic padding adds few pad tokens;
+        # packed rows are already close to pack_length
+        group_by_length=not args.packing,
+        length_column_name="length",
+        evaluation_strategy="no",
+        num_train_epochs=3,
+        logging_steps=10,
+        save_steps=100,
+        save_total_limit=2,
+        fp16=True,
+        report_to="none",
+    )
+
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=dataset,
+        tokenizer=tokenizer,
+        data_collator=data_collator,
+    )
+
+    trainer.train()
+
+if __name__ == "__main__":
+    main()